@@ -0,0 +1,276 @@
+"""Module, checks query plans of DbClient
+
+utils.DbClient のすべてのクエリについて EXPLAIN を実行し、フルテーブルスキャン(type=ALL)になるものがあれば失敗するスクリプトです。
+インデックスが消えたり、クエリの形が変わってインデックスが効かなくなったりしたことに気づくためのものです。
+
+NOTE: 行数が少ないとオプティマイザはインデックスを使わないことがあるので、
+      ローカルの DB に本番相当の件数を投入してから確認します。
+      データを投入するので、 .env の MYSQL_HOST はローカルの DB に向けてください。
+
+python check_query_plans.py
+"""
+
+
+# Built-in modules.
+from decimal import Decimal
+import argparse
+import datetime
+import inspect
+import random
+import sys
+import pytz
+
+# User modules.
+import consts
+import migrate
+import utils
+
+# ロガーを取得します。
+logger = utils.get_my_logger(__name__)
+
+# 各クエリを EXPLAIN するときの引数です。
+# NOTE: DbClient にクエリを足したらここにも足してください。足していないと失敗します。
+QUERY_CALLS = {
+    'fetch_completed_tradings': dict(user=1),
+    'fetch_completed_tradings_with_stock': dict(user=1),
+    'fetch_open_tradings': dict(user=1),
+    'fetch_stocks': dict(after_id=2000, limit=consts.STOCK_CHUNK_SIZE),
+    'fetch_latest_stock_logs': dict(
+        stock_ids=list(range(2001, 2001 + consts.STOCK_CHUNK_SIZE))),
+    'fetch_unfinished_run': dict(),
+    'acquire_run_lock': dict(),
+    'release_run_lock': dict(),
+    'create_run': dict(owner='check_query_plans',
+                       lease_seconds=consts.RUN_LEASE_SECONDS),
+    'acquire_run_lease': dict(run_id=1, owner='check_query_plans',
+                              lease_seconds=consts.RUN_LEASE_SECONDS),
+    'release_run_lease': dict(run_id=1, owner='check_query_plans'),
+    'finish_run': dict(run_id=1, owner='check_query_plans'),
+    'fetch_finished_stock_ids': dict(
+        run_id=1, stock_ids=list(range(2001, 2001 + consts.STOCK_CHUNK_SIZE))),
+    'save_batch': dict(
+        run_id=1,
+        stock_logs=[dict(stock_id=1, price=Decimal('100'))],
+        operations=[
+            dict(user_id=1, action='buy', stock_id=1, price=Decimal('100')),
+            dict(user_id=1, action='sell', stock_id=1, price=Decimal('110')),
+        ],
+        finished_stock_ids=[1]),
+}
+
+# DbClient のうち、確認の対象外とするメソッドです。
+# NOTE: sample_* は存在しない sampletable を使う、書き方の見本です。
+EXCLUDED_METHODS = {'sample_select', 'sample_update'}
+
+
+class ExplainingCursor:
+    """execute されたクエリを実行せず、 EXPLAIN の結果を記録するカーソルです。"""
+
+    def __init__(self, connection, plans: list):
+        self.cursor = connection.cursor(dictionary=True)
+        self.plans = plans
+        self.lastrowid = None
+        self.rowcount = 0
+
+    def execute(self, sql: str, params: tuple = ()) -> None:
+        self.cursor.execute(f'EXPLAIN {sql}', params)
+        self.plans.append(dict(sql=sql, rows=self.cursor.fetchall()))
+
+    def fetchall(self) -> list:
+        return []
+
+    def fetchone(self) -> dict:
+        return None
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class ExplainingConnection:
+    """ExplainingCursor を返すコネクションです。 commit は何もしません。"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.plans = []
+
+    def cursor(self, *args, **kwargs) -> ExplainingCursor:
+        return ExplainingCursor(self.connection, self.plans)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ExplainingDbClient(utils.DbClient):
+    """クエリを実行せず EXPLAIN の結果を記録する DbClient です。
+    with ExplainingDbClient() as db_client:
+        db_client.fetch_open_tradings(user=1)
+        db_client.connection.plans
+    """
+
+    def __enter__(self):
+        super().__enter__()
+        self.connection = ExplainingConnection(self.connection)
+        return self
+
+
+def seed(stocks_count: int,
+         users_count: int,
+         tradings_count: int,
+         stock_logs_count: int,
+         runs_count: int) -> None:
+    """stock, trading, stock_log, run, run_stock に本番相当の件数のデータを投入します。
+    NOTE: stock がすでにあるときは投入しません。
+
+    Args:
+        stocks_count (int): stock の件数
+        users_count (int): 仮想ユーザの人数
+        tradings_count (int): 完了済み trading の件数
+        stock_logs_count (int): stock_log の件数
+        runs_count (int): 完了済み run の件数。直近 50 件は全銘柄を処理済みとします。
+    """
+
+    with utils.DbClient() as db_client:
+        cursor = db_client.connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM stock')
+        if cursor.fetchone()[0]:
+            logger.info('stock にデータがあるので投入しません。')
+            cursor.close()
+            return
+
+        logger.info(f'stock を {stocks_count} 件投入します。')
+        cursor.executemany(
+            'INSERT INTO stock (code, name) VALUES (%s, %s)',
+            [(str(1000 + i), f'stock-{i}') for i in range(stocks_count)]
+        )
+
+        now = datetime.datetime.now(tz=pytz.utc).replace(tzinfo=None)
+
+        def random_datetime() -> datetime.datetime:
+            return now - datetime.timedelta(minutes=random.randrange(60 * 24 * 365))
+
+        logger.info(f'trading を {tradings_count} 件投入します。')
+        for chunk in utils.iter_chunks(range(tradings_count), 5000):
+            rows = []
+            for _ in chunk:
+                bought_at = random_datetime()
+                buy = Decimal(random.randrange(10000, 1000000)) / 100
+                rows.append((
+                    random.randrange(1, stocks_count + 1),
+                    random.randrange(1, users_count + 1),
+                    buy, bought_at,
+                    buy * Decimal(random.choice(('0.97', '1.03'))),
+                    bought_at + datetime.timedelta(hours=random.randrange(1, 240)),
+                    bought_at,
+                ))
+            cursor.executemany(' '.join([
+                'INSERT INTO trading',
+                '(stock_id, user_id, buy, bought_at, sell, sold_at, created_at)',
+                'VALUES (%s, %s, %s, %s, %s, %s, %s)',
+            ]), rows)
+        # 保有中の trading です。仮想ユーザは全銘柄を一件ずつ保有しています。
+        for user_id in range(1, users_count + 1):
+            cursor.executemany(' '.join([
+                'INSERT INTO trading',
+                '(stock_id, user_id, buy, bought_at, created_at)',
+                'VALUES (%s, %s, %s, %s, %s)',
+            ]), [(stock_id, user_id, Decimal('100'), now, now)
+                 for stock_id in range(1, stocks_count + 1)])
+
+        logger.info(f'stock_log を {stock_logs_count} 件投入します。')
+        for chunk in utils.iter_chunks(range(stock_logs_count), 5000):
+            cursor.executemany(
+                'INSERT INTO stock_log (stock_id, price, created_at) VALUES (%s, %s, %s)',
+                [(random.randrange(1, stocks_count + 1),
+                  Decimal(random.randrange(10000, 1000000)) / 100,
+                  random_datetime())
+                 for _ in chunk]
+            )
+
+        logger.info(f'run を {runs_count} 件投入します。')
+        cursor.executemany(
+            'INSERT INTO run (started_at, finished_at) VALUES (%s, %s)',
+            [(now - datetime.timedelta(hours=i), now - datetime.timedelta(hours=i))
+             for i in range(runs_count, 0, -1)]
+        )
+        for run_id in range(max(runs_count - 50, 0) + 1, runs_count + 1):
+            cursor.executemany(
+                'INSERT INTO run_stock (run_id, stock_id) VALUES (%s, %s)',
+                [(run_id, stock_id) for stock_id in range(1, stocks_count + 1)]
+            )
+
+        db_client.connection.commit()
+        # NOTE: 統計情報を更新しておかないと、オプティマイザが件数を正しく見積もりません。
+        for table in ('stock', 'trading', 'stock_log', 'run', 'run_stock'):
+            cursor.execute(f'ANALYZE TABLE {table}')
+            cursor.fetchall()
+        cursor.close()
+
+
+def check_query_plans() -> list:
+    """DbClient のすべてのクエリを EXPLAIN し、問題を列挙します。
+
+    Returns:
+        list: 問題の説明のリスト。空なら問題なしです。
+    """
+
+    problems = []
+
+    # QUERY_CALLS に載っていないクエリがないか確認します。
+    method_names = {
+        name for name, _ in inspect.getmembers(utils.DbClient,
+                                               inspect.isfunction)
+        if not name.startswith('_')
+    } - EXCLUDED_METHODS
+    for name in sorted(method_names - set(QUERY_CALLS)):
+        problems.append(f'{name}: QUERY_CALLS に引数が定義されていません。')
+
+    for name, kwargs in QUERY_CALLS.items():
+        with ExplainingDbClient() as db_client:
+            getattr(db_client, name)(**kwargs)
+            plans = db_client.connection.plans
+        for plan in plans:
+            for row in plan['rows']:
+                logger.info(f'{name}: table={row["table"]} type={row["type"]}'
+                            f' key={row["key"]} rows={row["rows"]}')
+                # NOTE: INSERT 先の行は、テーブルを読まないので対象外です。
+                # NOTE: <derived2> のようなサブクエリの結果は実テーブルではないので対象外です。
+                if (row['type'] == 'ALL'
+                        and row['select_type'] != 'INSERT'
+                        and not (row['table'] or '').startswith('<')):
+                    problems.append(
+                        f'{name}: {row["table"]} がフルテーブルスキャンです。'
+                        f' SQL: {plan["sql"]}')
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fail if any DbClient query falls back to a full table scan.')
+    parser.add_argument('--stocks', type=int, default=4000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tradings', type=int, default=200000)
+    parser.add_argument('--stock-logs', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=2000)
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='Allow seeding a database that is not on localhost.')
+    args = parser.parse_args()
+
+    if (consts.MYSQL_HOST not in ('localhost', '127.0.0.1')
+            and not args.allow_remote):
+        logger.error(f'MYSQL_HOST がローカルではありません: {consts.MYSQL_HOST}')
+        sys.exit(1)
+
+    migrate.migrate()
+    seed(args.stocks, args.users, args.tradings, args.stock_logs, args.runs)
+    problems = check_query_plans()
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        sys.exit(1)
+    logger.info('フルテーブルスキャンになるクエリはありません。')
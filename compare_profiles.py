@@ -0,0 +1,79 @@
+"""Module, compares two profiles
+
+utils.ProfileSession が書き出した tsv (*.cpu.tsv, *.alloc.tsv) を二つ並べて比べるスクリプトです。
+差の大きい順に表示するので、パース、 Decimal の計算、 DB アクセスなどの遅くなった箇所を見つけられます。
+
+python compare_profiles.py profiles/main-20211001T000000Z.cpu.tsv profiles/main-20211002T000000Z.cpu.tsv
+"""
+
+
+# Built-in modules.
+import argparse
+import csv
+
+# 比べる列です。 cpu は累積時間、 alloc は確保の増加量で比べます。
+DEFAULT_COLUMNS = {
+    'function': 'cumtime',
+    'site': 'size_diff_kib',
+}
+
+
+def read_profile(path: str) -> tuple:
+    """tsv を読み込みます。
+
+    Args:
+        path (str): tsv のパス。
+
+    Returns:
+        tuple: (キーの列名, {キー: 行の dict})
+    """
+
+    with open(path, encoding='utf-8', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        key_column = reader.fieldnames[0]
+        return key_column, {row[key_column]: row for row in reader}
+
+
+def compare(before_path: str, after_path: str, column: str = None,
+            top_n: int = 30) -> list:
+    """二つの tsv を比べ、 column の差が大きい順に並べます。
+
+    Args:
+        before_path (str): 比較元の tsv のパス。
+        after_path (str): 比較先の tsv のパス。
+        column (str, optional): 比べる列。 Defaults to None. (cpu なら cumtime, alloc なら size_diff_kib)
+        top_n (int, optional): 返す件数。 Defaults to 30.
+
+    Returns:
+        list: [(キー, 比較元の値, 比較先の値, 差)]
+    """
+
+    key_column, before = read_profile(before_path)
+    _, after = read_profile(after_path)
+    column = column or DEFAULT_COLUMNS[key_column]
+
+    # NOTE: 片方の上位にしか現れないものは、もう片方を 0 として扱います。
+    rows = []
+    for key in sorted(set(before) | set(after)):
+        before_value = float(before[key][column]) if key in before else 0.0
+        after_value = float(after[key][column]) if key in after else 0.0
+        rows.append((key, before_value, after_value, after_value - before_value))
+    rows.sort(key=lambda row: (-abs(row[3]), row[0]))
+    return rows[:top_n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare two profile summaries side by side.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--column',
+                        help='Column to compare. Defaults to cumtime for'
+                             ' *.cpu.tsv and size_diff_kib for *.alloc.tsv.')
+    parser.add_argument('--top', type=int, default=30)
+    args = parser.parse_args()
+
+    print('\t'.join(['before', 'after', 'delta', 'key']))
+    for key, before_value, after_value, delta in compare(
+            args.before, args.after, args.column, args.top):
+        print(f'{before_value:.6f}\t{after_value:.6f}\t{delta:+.6f}\t{key}')
@@ -39,10 +39,72 @@ MYSQL_DATABASE = get_env('MYSQL_DATABASE')
 SLACK_BOT_TOKEN = get_env('SLACK_BOT_TOKEN')
 SLACK_MESSAGE_CHANNEL = get_env('SLACK_MESSAGE_CHANNEL')
 
+# ログを JSON Lines で出力するファイルのパスです。
+# NOTE: 任意項目です。空ならコンソールにだけ出力します。
+LOG_JSONL_PATH = os.environ.get('LOG_JSONL_PATH', '')
+
+# 設定されていれば、実行ごとに CPU とメモリのプロファイルを書き出します。
+# NOTE: 任意項目です。コマンドライン引数に --profile を付けても有効になります。
+SHUUMULATOR_PROFILE = os.environ.get('SHUUMULATOR_PROFILE', '')
+# プロファイルを書き出すディレクトリです。
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# プロファイルの要約に載せる件数です。
+PROFILE_TOP_N = 30
+
 # 利確ラインです。
 # NOTE: Decimal にするので文字列で定義します。
 PROFIT_BOOKING_RATE = '0.025'
 
+# 売買を行う仮想ユーザ(戦略)の一覧です。株価は一回の実行で一度だけ取得し、全員に配ります。
+# NOTE: loss_cut_rate が None のユーザは、勝率から Mr.S の計算式で損切ラインを算出します。
+#       固定の損切ラインで売買させたいユーザは loss_cut_rate を文字列で定義します。
+# NOTE: 例えば dict(user_id=2, profit_booking_rate='0.05', loss_cut_rate='0.03') を足すと、
+#       利確 5%, 損切 3% 固定のユーザが同じ銘柄を並行して売買します。
+VIRTUAL_USERS = [
+    dict(user_id=1, profit_booking_rate=PROFIT_BOOKING_RATE, loss_cut_rate=None),
+]
+
+# 対象銘柄を DB から一度に取得する件数です。
+STOCK_CHUNK_SIZE = 100
+# 何銘柄ぶんの株価がそろったら仮想ユーザに配って売買させるかです。
+DEAL_BATCH_SIZE = 10
+# 株価が DEAL_BATCH_SIZE 件そろわなくても、最初の株価が届いてからこの秒数が経ったら売買させます。
+# NOTE: 株価の取得は一件ごとに待機するので、そろうのを待つと最初の株価が古くなります。
+DEAL_BATCH_MAX_WAIT_SECONDS = 15.0
+# 株価取得と売買の間に置くキューの上限件数です。
+PIPELINE_QUEUE_SIZE = 20
+
+# run を開始するときに取る MySQL のロック(GET_LOCK)の名前です。
+RUN_LOCK_NAME = 'shuumulator_run'
+# run のリースの秒数です。処理中の実行はバッチごとに延長します。
+# NOTE: 延長されないまま過ぎたら、その実行は止まったものとみなし、次の実行が run を再開します。
+RUN_LEASE_SECONDS = 1800
+
+# 一銘柄を一回の実行で何回まで株価取得するかです。
+# NOTE: 利確ライン、損切ラインに近い銘柄ほど多く取得し、遠い銘柄は取得を見送ります。
+#       一回の実行で取得する回数の合計は、銘柄数を超えません。
+POLL_MAX_PER_RUN = 3
+# 遠い銘柄でも、最後に株価を取得してからこの時間が経っていれば取得します。
+# NOTE: 取得を見送っている間に株価がラインを越えても、この時間以内には気づけます。
+POLL_MAX_INTERVAL_HOURS = 3
+# ラインまでの距離(割合)で重み付けするときに、ゼロ除算を避けるために足す値です。
+POLL_DISTANCE_EPSILON = '0.001'
+
+# 株価スクレイピングのタイムアウト秒数です。
+FETCH_TIMEOUT_SECONDS = 10
+# 株価スクレイピングの、一銘柄あたりの最大試行回数です。
+FETCH_MAX_ATTEMPTS = 3
+# 株価スクレイピングの、一回の実行全体で使える再試行回数です。
+FETCH_RETRY_BUDGET = 20
+# 株価スクレイピングの再試行バックオフの基準秒数です。
+FETCH_RETRY_BASE_DELAY_SECONDS = 2.0
+# 株価スクレイピングがこの回数連続で失敗したら、サイトが落ちているとみなして止めます。
+FETCH_CIRCUIT_BREAKER_THRESHOLD = 5
+# サイトが落ちているとみなしてから、再度試すまでの秒数です。
+FETCH_CIRCUIT_BREAKER_RESET_SECONDS = 300
+# サイトが落ちているとみなしてから、試しの取得がこの回数続けて失敗したら、この実行では諦めます。
+FETCH_CIRCUIT_BREAKER_MAX_PROBES = 3
+
 if __name__ == '__main__':
     print(repr(MYSQL_HOST))
     print(repr(MYSQL_USER))
@@ -1,7 +1,8 @@
 # NOTE: ざくざく実装するためひとつのファイルにすべてまとめています。のちに整理します。
 
 # Built-in modules.
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import collections
 import datetime
 import pytz
 
@@ -13,6 +14,27 @@ from bs4 import BeautifulSoup
 import consts
 import utils
 
+# ロガーを取得します。
+logger = utils.get_my_logger(__name__)
+
+
+class StockPriceFetchError(Exception):
+    """株価のスクレイピングに失敗したことを表す例外です。"""
+
+
+class TransientStockPriceFetchError(StockPriceFetchError):
+    """株価のスクレイピングに一時的に失敗したことを表す例外です。(5xx, 429, 403 など)
+    再試行すれば取得できる見込みがあります。
+    """
+
+
+class PermanentStockPriceFetchError(StockPriceFetchError):
+    """株価のスクレイピングに失敗し、再試行しても直らないことを表す例外です。(404 などの 4xx, ページの形が違う)
+    その銘柄だけの問題とみなし、再試行しません。
+    NOTE: ただし、違う銘柄で続けて起きるときはサイト全体の問題(作りが変わったなど)なので、
+          サーキットブレーカーには失敗として数えます。
+    """
+
 
 def market_is_open() -> bool:
     """9〜15時であれば True を返します。
@@ -28,12 +50,6 @@ def market_is_open() -> bool:
     return 9 <= current_hour <= 15
 
 
-def get_profit_booking_rate() -> Decimal:
-    """利確ラインを取得します。"""
-
-    return Decimal(consts.PROFIT_BOOKING_RATE)
-
-
 def get_user_wins_rate(user_id: int) -> Decimal:
     """ユーザの現在の勝率を算出します。
 
@@ -63,16 +79,62 @@ def get_user_wins_rate(user_id: int) -> Decimal:
     return wins_rate
 
 
-def get_target_stocks() -> list:
-    """対象銘柄を取得します。
+def iter_target_stocks(chunk_size: int):
+    """対象銘柄を chunk_size 件ずつ、 id 順に取得するジェネレータです。
+    NOTE: 全件をメモリに載せないよう、 keyset pagination で少しずつ取得します。
+
+    Args:
+        chunk_size (int): 一度に取得する件数。
+
+    Yields:
+        dict: stock
+    """
+
+    last_stock_id = 0
+    while True:
+        with utils.DbClient() as db_client:
+            stocks = db_client.fetch_stocks(after_id=last_stock_id,
+                                            limit=chunk_size)
+        yield from stocks
+        if len(stocks) < chunk_size:
+            return
+        last_stock_id = stocks[-1]['id']
+
+
+def get_strategies() -> list:
+    """consts.VIRTUAL_USERS から、仮想ユーザごとの売買戦略を作成します。
+    戦略は利確レート、損切レート、勝率と、保有中の trading を持ちます。
 
     Returns:
-        list: stocks
+        list: [{user_id, profit_booking_rate, loss_cut_rate, user_wins_rate, open_tradings}]
+              open_tradings は {stock_id: trading} です。
     """
 
-    # 処理対象の銘柄一覧を取得します。
-    with utils.DbClient() as db_client:
-        return db_client.fetch_stocks()
+    strategies = []
+    for virtual_user in consts.VIRTUAL_USERS:
+        user_id = virtual_user['user_id']
+        profit_booking_rate = Decimal(virtual_user['profit_booking_rate'])
+        user_wins_rate = get_user_wins_rate(user_id)
+
+        # 損切ラインを決めます。
+        # NOTE: 固定で指定されていなければ、利確ラインと勝率から算出します。
+        loss_cut_rate = (Decimal(virtual_user['loss_cut_rate'])
+                         if virtual_user['loss_cut_rate'] is not None
+                         else get_loss_cut_rate(profit_booking_rate,
+                                                user_wins_rate))
+
+        # 保有中の trading をまとめて取得しておきます。売買の判断はこれをもとにメモリ上で行います。
+        with utils.DbClient() as db_client:
+            open_tradings = db_client.fetch_open_tradings(user_id)
+
+        strategies.append(dict(
+            user_id=user_id,
+            profit_booking_rate=profit_booking_rate,
+            loss_cut_rate=loss_cut_rate,
+            user_wins_rate=user_wins_rate,
+            open_tradings={t['stock_id']: t for t in open_tradings},
+        ))
+    return strategies
 
 
 def get_loss_cut_rate(profit_booking_rate: Decimal,
@@ -130,94 +192,343 @@ def get_current_stock_price(stock_code: str) -> dict:
     Args:
         stock_code (str): 銘柄コード
 
+    Raises:
+        TransientStockPriceFetchError: ページの取得に一時的に失敗した。(5xx, 429, 403)
+        PermanentStockPriceFetchError: ページがないか、株価の抽出に失敗した。
+        requests.RequestException: 通信に失敗した。(タイムアウトなど)
+
     Returns:
         dict: {data_price=現在の株価, data_short_name=銘柄の短縮名}
     """
 
     # Web ページを取得します。
-    response = requests.get(f'https://minkabu.jp/stock/{stock_code}')
-    assert response.status_code == 200, (
-        f'株価のスクレイピングに失敗しました。アクセス先: https://minkabu.jp/stock/{stock_code}'
-    )
+    url = f'https://minkabu.jp/stock/{stock_code}'
+    response = requests.get(url, timeout=consts.FETCH_TIMEOUT_SECONDS)
+    # NOTE: 403 はボット対策でサイト全体から弾かれているときに返ります。銘柄の問題ではないので一時的な失敗とします。
+    if response.status_code >= 500 or response.status_code in (403, 429):
+        raise TransientStockPriceFetchError(
+            f'株価のスクレイピングに失敗しました。アクセス先: {url},'
+            f' ステータス: {response.status_code}')
+    if response.status_code != 200:
+        raise PermanentStockPriceFetchError(
+            f'株価のスクレイピングに失敗しました。アクセス先: {url},'
+            f' ステータス: {response.status_code}')
 
     # 株価が格納されているのは #stock-for-securities-company の data-price attribute です。
     # BeautifulSoup によって抽出します。
     soup = BeautifulSoup(response.text, 'lxml')
-    data_price = soup.select_one(
-        '#stock-for-securities-company')['data-price']
-    data_short_name = soup.select_one(
-        '#stock-for-securities-company')['data-short-name']
+    element = soup.select_one('#stock-for-securities-company')
+    if (element is None
+            or not element.get('data-price')
+            or not element.get('data-short-name')):
+        raise PermanentStockPriceFetchError(
+            f'株価の要素が見つかりませんでした。アクセス先: {url}')
+    data_price = element['data-price']
+    data_short_name = element['data-short-name']
 
     # NOTE: リポジトリ全体で Decimal を使っています。ここも Decimal で返却します。
+    try:
+        data_price = Decimal(data_price)
+    except InvalidOperation:
+        raise PermanentStockPriceFetchError(
+            f'株価を数値として読めませんでした。アクセス先: {url}, 値: {data_price}')
     return dict(
-        data_price=Decimal(data_price),
+        data_price=data_price,
         data_short_name=data_short_name)
 
 
-def deal_in(stock_id: int,
-            current_stock_price: Decimal,
-            profit_booking_rate: Decimal,
-            loss_cut_rate: Decimal) -> dict:
-    """対象 stock の買付と売付を行います。
+def fetch_current_stock_price(stock_code: str,
+                              retry_budget: utils.RetryBudget,
+                              circuit_breaker: utils.CircuitBreaker) -> dict:
+    """get_current_stock_price を、再試行とサーキットブレーカーつきで呼びます。
+    一時的に不調なページは再試行で拾い、サイトが落ちているときは呼び出しを止めます。
+    NOTE: ページがない、ページの形が違うといった失敗は再試行しません。
+          サーキットブレーカーには数えるので、違う銘柄で続けて起きたら(サイトの作りが変わったなど)呼び出しを止めます。
+          間に成功があれば数え直すので、壊れた銘柄が散らばっているだけなら止めません。
+
+    Args:
+        stock_code (str): 銘柄コード
+        retry_budget (utils.RetryBudget): 一回の実行全体で共有する再試行予算
+        circuit_breaker (utils.CircuitBreaker): 一回の実行全体で共有するサーキットブレーカー
+
+    Raises:
+        TransientStockPriceFetchError: 再試行しても株価を取得できなかった。
+        PermanentStockPriceFetchError: ページがないか、株価の抽出に失敗した。(再試行しません)
+        requests.RequestException: 再試行しても通信に失敗した。
+        utils.CircuitOpenError: サーキットブレーカーが開いている。
+
+    Returns:
+        dict: {data_price=現在の株価, data_short_name=銘柄の短縮名}
+    """
+
+    return utils.call_with_retry(
+        get_current_stock_price,
+        stock_code,
+        max_attempts=consts.FETCH_MAX_ATTEMPTS,
+        retry_budget=retry_budget,
+        circuit_breaker=circuit_breaker,
+        base_delay=consts.FETCH_RETRY_BASE_DELAY_SECONDS,
+        retry_on=(requests.RequestException, TransientStockPriceFetchError),
+        record_on=(PermanentStockPriceFetchError,),
+    )
+
+
+def get_exit_prices(buy_price: Decimal, strategy: dict) -> tuple:
+    """取得価格と戦略から、利確ラインと損切ラインの価格を算出します。
+
+    Args:
+        buy_price (Decimal): 取得価格
+        strategy (dict): get_strategies で作成した戦略
+
+    Returns:
+        tuple: (利確ラインの価格, 損切ラインの価格)
+    """
+
+    profit_booking_price = (
+        buy_price + buy_price * strategy['profit_booking_rate'])
+    loss_cut_price = (buy_price - buy_price * strategy['loss_cut_rate'])
+    return profit_booking_price, loss_cut_price
+
+
+def get_exit_distance(stock_id: int,
+                      last_price: Decimal,
+                      strategies: list) -> Decimal:
+    """直近の株価から、利確ラインか損切ラインまでの距離(割合)を算出します。
+    すべての仮想ユーザのうち、いちばん近いものを返します。
+    NOTE: 手持ちのないユーザがいれば、その銘柄は次の取得で必ず買います。距離はないので None を返します。
+    NOTE: 直近の株価が 0 以下(取得の不具合などで記録されたもの)なら、割合を出せないので None を返します。
+
+    Args:
+        stock_id (int): stock.id
+        last_price (Decimal): 直近の株価
+        strategies (list): get_strategies で作成した戦略の一覧
+
+    Returns:
+        Decimal or None: ラインまでの距離。 0.01 なら 1% 動けばラインに届きます。
+                         距離を出せないときは None です。
+    """
+
+    if last_price <= 0:
+        return None
+    distances = []
+    for strategy in strategies:
+        trading = strategy['open_tradings'].get(stock_id)
+        if trading is None:
+            return None
+        profit_booking_price, loss_cut_price = get_exit_prices(
+            trading['buy'], strategy)
+        distance = min(profit_booking_price - last_price,
+                       last_price - loss_cut_price) / last_price
+        distances.append(max(distance, Decimal('0')))
+    return min(distances, default=None)
+
+
+def plan_polls(stocks: list,
+               latest_stock_logs: list,
+               strategies: list,
+               budget: int) -> list:
+    """stocks の株価を、どの銘柄を何回取得するか決めます。
+    - ラインに近い銘柄ほど多く取得します。(最大 consts.POLL_MAX_PER_RUN 回)
+    - ラインから遠い銘柄は、取得を見送ることがあります。
+      ただし距離は最後に取得してからの時間が長いほど縮めるので、見送った銘柄もいずれ取得します。
+    - しばらく取得していない銘柄は、必ず一回は取得します。
+    - 買うことが決まっている銘柄、一度も取得していない銘柄、直近の株価が 0 以下の銘柄は、一回だけ取得します。
+    取得回数の合計は budget を超えません。(必ず取得する銘柄が budget より多いときを除きます。)
+
+    Args:
+        stocks (list): stock のリスト
+        latest_stock_logs (list): 銘柄ごとの最新の stock_log のリスト
+        strategies (list): get_strategies で作成した戦略の一覧
+        budget (int): 取得回数の合計の上限
+
+    Returns:
+        list: 取得する順に並べた stock のリスト。同じ銘柄が複数回現れます。
+    """
+
+    latest_stock_logs = {log['stock_id']: log for log in latest_stock_logs}
+    current_utc = datetime.datetime.now(tz=pytz.utc).replace(tzinfo=None)
+    max_interval = datetime.timedelta(hours=consts.POLL_MAX_INTERVAL_HOURS)
+    epsilon = Decimal(consts.POLL_DISTANCE_EPSILON)
+
+    # 一回だけ取得する銘柄と、距離で取得回数を決める銘柄に分けます。
+    once_plans = []
+    plans = []
+    for stock in stocks:
+        log = latest_stock_logs.get(stock['id'])
+        distance = (get_exit_distance(stock['id'], log['price'], strategies)
+                    if log
+                    else None)
+        if distance is None:
+            once_plans.append(dict(stock=stock, polls=1))
+            continue
+        elapsed = current_utc - log['created_at']
+        # NOTE: 株価は取得していない間も動くので、最後に取得してからの時間が長いほど距離を縮めます。
+        #       動く幅はおおむね経過時間の平方根に比例するので、距離を経過時間(時間)の平方根で割ります。
+        #       こうしないと、見送った銘柄は次に取得するまで遠いままで、取得されないままになります。
+        elapsed_hours = Decimal(int(elapsed.total_seconds())) / 3600
+        distance /= max(elapsed_hours, Decimal('1')).sqrt()
+        required = elapsed >= max_interval
+        plans.append(dict(stock=stock,
+                          distance=distance,
+                          required=required,
+                          polls=1 if required else 0))
+    # 近い順に並べます。
+    plans.sort(key=lambda p: p['distance'])
+    budget -= len(once_plans)
+
+    # 距離の逆数に比例して取得回数を配ります。
+    weights = [1 / (p['distance'] + epsilon) for p in plans]
+    total_weight = sum(weights)
+    for plan, weight in zip(plans, weights):
+        plan['polls'] = max(
+            plan['polls'],
+            min(consts.POLL_MAX_PER_RUN,
+                int(max(budget, 0) * weight / total_weight)))
+
+    # 予算を超えていれば、遠いものから減らします。
+    over = sum(p['polls'] for p in plans) - budget
+    for plan in reversed(plans):
+        if over <= 0:
+            break
+        reducible = plan['polls'] - (1 if plan['required'] else 0)
+        reduced = min(reducible, over)
+        plan['polls'] -= reduced
+        over -= reduced
+
+    # 予算が余っていれば、近いものから一回ずつ足します。
+    leftover = budget - sum(p['polls'] for p in plans)
+    while leftover > 0:
+        addable = [p for p in plans if p['polls'] < consts.POLL_MAX_PER_RUN]
+        if not addable:
+            break
+        for plan in addable[:leftover]:
+            plan['polls'] += 1
+        leftover -= len(addable[:leftover])
+
+    # 一巡目で全銘柄を一回ずつ、二巡目で二回目の銘柄を……と並べ、同じ銘柄の取得の間隔を空けます。
+    # NOTE: 各巡は銘柄の id 順です。 stock_log のない銘柄(新しい銘柄、取得に失敗し続ける銘柄)を
+    #       先頭に固めると、それらが壊れているときに毎回実行の最初でつまずくので、散らします。
+    plans = sorted(once_plans + plans, key=lambda p: p['stock']['id'])
+    stocks_to_poll = []
+    for round_index in range(consts.POLL_MAX_PER_RUN):
+        stocks_to_poll.extend(p['stock'] for p in plans
+                              if p['polls'] > round_index)
+    return stocks_to_poll
+
+
+def iter_scheduled_stocks(stocks,
+                          strategies: list,
+                          chunk_size: int,
+                          run_id: int):
+    """stocks を chunk_size 件ずつ plan_polls で並べ直して返すジェネレータです。
+    取得回数の予算は chunk ごとに chunk の件数とします。合計すると全銘柄一回ずつと同じです。
+    run のなかで処理の済んだ銘柄は飛ばします。途中で止まった run を再開したときは、残りの銘柄だけを返します。
+
+    Args:
+        stocks: stock の iterable
+        strategies (list): get_strategies で作成した戦略の一覧
+        chunk_size (int): 一度に並べ直す件数
+        run_id (int): run.id
+
+    Yields:
+        tuple: (株価を取得する stock, その銘柄のこの run での最後の取得かどうか)
+    """
+
+    for chunk in utils.iter_chunks(stocks, chunk_size):
+        stock_ids = [stock['id'] for stock in chunk]
+        with utils.DbClient() as db_client:
+            finished_stock_ids = db_client.fetch_finished_stock_ids(
+                run_id, stock_ids)
+            chunk = [stock for stock in chunk
+                     if stock['id'] not in finished_stock_ids]
+            latest_stock_logs = db_client.fetch_latest_stock_logs(
+                [stock['id'] for stock in chunk])
+        stocks_to_poll = plan_polls(chunk,
+                                    latest_stock_logs,
+                                    strategies,
+                                    budget=len(chunk))
+        polls_left = collections.Counter(stock['id'] for stock in stocks_to_poll)
+        logger.info(f'{len(stock_ids)} 銘柄のうち、処理済み {len(finished_stock_ids)} 銘柄を除き、'
+                    f'{len(polls_left)} 銘柄について、のべ {len(stocks_to_poll)} 回株価を取得します。')
+        for stock in stocks_to_poll:
+            polls_left[stock['id']] -= 1
+            yield stock, polls_left[stock['id']] == 0
+
+
+def deal_in(strategy: dict, quotes: list) -> dict:
+    """ひとりの仮想ユーザ(strategy)について、複数銘柄の買付と売付を判断します。
     - もってない -> 買う
     - 現在価格が利確ラインより上 -> 売る
     - 現在価格が損切ラインより下 -> 売る
     - それ以外 -> キープ
-    判断結果は {message} の形式で返却します。
+    判断は保有中の trading をもとにメモリ上で行います。 DB への書き込みは呼び出し元がまとめて行います。
+    判断結果は銘柄ごとに {quote, action, message} の形式で返却します。 action は buy, sell, keep のいずれかです。
 
     Args:
-        stock_id (int): trading.stock
-        current_stock_price (Decimal): 現在価格
-        profit_booking_rate (Decimal): 利確レート。取得価格にこれをかけて利確ラインを算出します。
-        loss_cut_rate (Decimal): 損切レート。取得価格にこれをかけて損切ラインを算出します。
+        strategy (dict): get_strategies で作成した戦略。
+        quotes (list): 株価の一覧。 [{stock, data_price, data_short_name}]
 
     Returns:
-        dict: 行った処理を呼び出し元に伝えるメッセージを含む dict です。
+        dict: {results, operations, open_tradings}
+              results は行った処理を呼び出し元に伝えるメッセージを含む dict のリストです。
+              operations は DbClient.save_batch に渡す書き込みのリストです。
+              open_tradings は売買後の保有状況です。書き込みに成功したら strategy に反映します。
     """
 
-    # この stock の最新 trading 情報を取得します。
-    with utils.DbClient() as db_client:
-        newest_trading = db_client.fetch_newest_trading(
-            stock_id
-        )
-
-    # この stock は手持ちがあるかどうかを判断します。
-    # NOTE: そもそも trading が無い -> 当然、手持ち無し
-    # NOTE: sold_at が埋まっている -> 売却済み -> 手持ち無し
-    holds_this_stock = (not newest_trading['sold_at']
-                        if newest_trading
-                        else False)
-
-    # 手持ちがなければ、有無を言わさず買います。
-    if not holds_this_stock:
-        # NOTE: 買うということは trading に一件追加するということです。
-        with utils.DbClient() as db_client:
-            db_client.create_trading(
-                stock_id=stock_id,
-                user_id=1,
-                price=current_stock_price,
-            )
-        return dict(message=f'現在の価格:{current_stock_price}, 買付しました。')
-
-    # この stock の手持ちがある場合は、売るかどうかの判断に進みます。
-    # 売るのは、利確ラインを超えているとき、あるいは損切ラインを下回っているときです。
-    buy_price = newest_trading['buy']
-    profit_booking_price = (buy_price + buy_price * profit_booking_rate)
-    loss_cut_price = (buy_price - buy_price * loss_cut_rate)
-    message = (
-        f'利確:{profit_booking_price},'
-        f'損切:{loss_cut_price},'
-        f'現在の価格:{current_stock_price}')
-    if (current_stock_price >= profit_booking_price
-            or current_stock_price <= loss_cut_price):
-        # NOTE: 売るということは trading.sell を埋めるということです。
-        with utils.DbClient() as db_client:
-            db_client.update_trading(
-                trading_id=newest_trading['id'],
-                sell_price=current_stock_price,
-            )
-        return dict(message=f'{message}, 売付しました。')
-    return dict(message=f'{message}, 売付しません。')
+    # NOTE: 書き込みに失敗したときに保有状況がずれないよう、コピーの上で判断します。
+    open_tradings = dict(strategy['open_tradings'])
+    operations = []
+    results = []
+
+    for quote in quotes:
+        stock_id = quote['stock']['id']
+        current_stock_price = quote['data_price']
+
+        # この stock は手持ちがあるかどうかを判断します。
+        trading = open_tradings.get(stock_id)
+
+        # 手持ちがなければ、有無を言わさず買います。
+        if trading is None:
+            # NOTE: 買うということは trading に一件追加するということです。
+            open_tradings[stock_id] = dict(stock_id=stock_id,
+                                           buy=current_stock_price)
+            operations.append(dict(user_id=strategy['user_id'],
+                                   action='buy',
+                                   stock_id=stock_id,
+                                   price=current_stock_price))
+            results.append(dict(
+                quote=quote,
+                action='buy',
+                message=f'現在の価格:{current_stock_price}, 買付しました。'))
+            continue
+
+        # この stock の手持ちがある場合は、売るかどうかの判断に進みます。
+        # 売るのは、利確ラインを超えているとき、あるいは損切ラインを下回っているときです。
+        profit_booking_price, loss_cut_price = get_exit_prices(
+            trading['buy'], strategy)
+        message = (
+            f'利確:{profit_booking_price},'
+            f'損切:{loss_cut_price},'
+            f'現在の価格:{current_stock_price}')
+        if (current_stock_price >= profit_booking_price
+                or current_stock_price <= loss_cut_price):
+            # NOTE: 売るということは trading.sell を埋めるということです。
+            del open_tradings[stock_id]
+            operations.append(dict(user_id=strategy['user_id'],
+                                   action='sell',
+                                   stock_id=stock_id,
+                                   price=current_stock_price))
+            results.append(dict(quote=quote,
+                                action='sell',
+                                message=f'{message}, 売付しました。'))
+            continue
+        results.append(dict(quote=quote,
+                            action='keep',
+                            message=f'{message}, 売付しません。'))
+
+    return dict(results=results,
+                operations=operations,
+                open_tradings=open_tradings)
 
 
 if __name__ == '__main__':
@@ -7,81 +7,367 @@
 
 # Built-in modules.
 import datetime
+import os
 import pytz
+import socket
 import time
 
 # User modules.
+import consts
 import utils
 import functions
 
+# ロガーを取得します。
+logger = utils.get_my_logger(__name__)
 
+
+def fetch_quote(stock: dict,
+                retry_budget: utils.RetryBudget,
+                circuit_breaker: utils.CircuitBreaker) -> dict:
+    """ひとつの銘柄について、株価を取得します。
+
+    Args:
+        stock (dict): stock
+        retry_budget (utils.RetryBudget): この実行全体で共有する再試行予算
+        circuit_breaker (utils.CircuitBreaker): この実行全体で共有するサーキットブレーカー
+
+    Returns:
+        dict: {stock, data_price, data_short_name, latency}
+    """
+
+    # スクレイピング先に負荷をかけることを避けるため、待機します。
+    time.sleep(5)
+
+    # スクレイピングで現在の価格を取得します。
+    fetch_started_at = time.perf_counter()
+    quote = functions.fetch_current_stock_price(stock['code'],
+                                                retry_budget,
+                                                circuit_breaker)
+    quote['latency'] = time.perf_counter() - fetch_started_at
+    quote['stock'] = stock
+    return quote
+
+
+def iter_quotes(run_id: int,
+                scheduled_stocks,
+                retry_budget: utils.RetryBudget,
+                circuit_breaker: utils.CircuitBreaker,
+                failed_codes: list):
+    """scheduled_stocks の株価を順に取得して返すジェネレータです。
+    失敗した銘柄は failed_codes に追加し、残りの銘柄の処理を続けます。
+    サイトが落ちているとみなしている間は待ってから試し、試しが続けて失敗したら残りを諦めます。
+    ページが壊れている銘柄は処理済みとして記録し、この run では取得し直しません。
+
+    Args:
+        run_id (int): run.id
+        scheduled_stocks: functions.iter_scheduled_stocks が返す (stock, 最後の取得かどうか) の iterable
+        retry_budget (utils.RetryBudget): この実行全体で共有する再試行予算
+        circuit_breaker (utils.CircuitBreaker): この実行全体で共有するサーキットブレーカー
+        failed_codes (list): 処理に失敗した銘柄コードを追加するリスト
+
+    Yields:
+        dict: fetch_quote で取得した株価。 is_last_poll を足して返します。
+    """
+
+    # ページが壊れていて取得を諦めた銘柄です。
+    broken_stock_ids = set()
+
+    for stock, is_last_poll in scheduled_stocks:
+        # NOTE: stock は dict です。 { code, name }
+
+        # NOTE: 同じ銘柄を複数回取得するときも、ページが壊れている銘柄は一回で諦めます。
+        if stock['id'] in broken_stock_ids:
+            continue
+
+        # NOTE: 試しの取得が続けて失敗し、サイトが落ちていると諦めた後は、リクエストせずに失敗扱いとします。
+        if circuit_breaker.is_exhausted():
+            failed_codes.append(stock['code'])
+            continue
+
+        # NOTE: サイトが落ちているとみなしている間は、 reset_timeout 秒待ってから試しに一件だけ取得します。
+        #       残りの銘柄をすぐに失敗扱いにすると、一時的な不調でも実行の後半がまるごと抜けてしまいます。
+        wait_seconds = circuit_breaker.seconds_until_allowed()
+        if wait_seconds > 0:
+            logger.warning(f'サイトが落ちているとみなしています。'
+                           f' {wait_seconds:.0f} 秒待ってから {stock["code"]} で試します。'
+                           f' (失敗した試し {circuit_breaker.failed_probes}'
+                           f'/{circuit_breaker.max_probes})')
+            time.sleep(wait_seconds)
+
+        # NOTE: ひとつの銘柄の失敗で、残りの銘柄の処理を止めないようにします。
+        try:
+            quote = fetch_quote(stock, retry_budget, circuit_breaker)
+        except utils.CircuitOpenError:
+            logger.warning(f'{stock["id"]} {stock["code"]} はサイトが落ちているとみなしスキップしました。')
+            failed_codes.append(stock['code'])
+            continue
+        except functions.PermanentStockPriceFetchError as e:
+            # NOTE: ページがない、ページの形が違うなど、この銘柄だけの問題です。
+            logger.warning(f'{stock["id"]} {stock["code"]} の株価を取得できませんでした。 {e}')
+            failed_codes.append(stock['code'])
+            broken_stock_ids.add(stock['id'])
+            # NOTE: 再開しても同じ結果になるので、処理済みとして記録し、次の実行で取得し直さないようにします。
+            #       記録しないと、再開するたびにこの銘柄でつまずき、 run がいつまでも終わりません。
+            try:
+                with utils.DbClient() as db_client:
+                    db_client.save_batch(run_id,
+                                         stock_logs=[],
+                                         operations=[],
+                                         finished_stock_ids=[stock['id']])
+            except Exception:
+                logger.exception(f'{stock["id"]} {stock["code"]} を処理済みとして記録できませんでした。')
+            continue
+        except Exception:
+            logger.exception(f'{stock["id"]} {stock["code"]} の処理に失敗しました。')
+            failed_codes.append(stock['code'])
+            continue
+        quote['is_last_poll'] = is_last_poll
+        yield quote
+
+
+def deal_in_for_strategies(run_id: int, strategies: list, quotes: list) -> None:
+    """取得した株価を、すべての仮想ユーザ(strategy)に配って売買させます。
+    株価の記録、全ユーザの売買、チェックポイントはひとつのトランザクションで書き込みます。
+    NOTE: 株価の取得は一度だけです。戦略を増やしてもリクエストは増えません。
+
+    Args:
+        run_id (int): run.id
+        strategies (list): functions.get_strategies で作成した戦略の一覧
+        quotes (list): fetch_quote で取得した株価の一覧
+    """
+
+    # ユーザごとに売買を判断します。
+    decisions = [(strategy, functions.deal_in(strategy, quotes))
+                 for strategy in strategies]
+
+    # まとめて書き込みます。
+    # NOTE: 書き込みの済んだ銘柄は、 run を再開しても処理し直しません。
+    #       最後の取得が済んだ銘柄だけを処理済みとして記録します。
+    with utils.DbClient() as db_client:
+        db_client.save_batch(
+            run_id,
+            # stock_log 保存。
+            # NOTE: これが必要なのかは微妙ですね。せっかく取得した情報がもったいないと思い、記録しています。
+            stock_logs=[dict(stock_id=quote['stock']['id'],
+                             price=quote['data_price'])
+                        for quote in quotes],
+            operations=[operation
+                        for _, decision in decisions
+                        for operation in decision['operations']],
+            finished_stock_ids=[quote['stock']['id']
+                                for quote in quotes
+                                if quote['is_last_poll']],
+        )
+
+    for strategy, decision in decisions:
+        # 書き込めたので、売買後の保有状況を反映します。
+        strategy['open_tradings'] = decision['open_tradings']
+
+        for result in decision['results']:
+            quote = result['quote']
+            stock = quote['stock']
+
+            # NOTE: 銘柄の名称には stock['name'] を使うこともできます。
+            #       ただ、スクレイピングで stock_price と一緒に取得した値のほうが正確だと考えこれを使っています。
+            #       stock.name が間違っている可能性を考慮しているということです。
+            logger.info(
+                f'user {strategy["user_id"]} {stock["id"]}'
+                f' {quote["data_short_name"]} {result["message"]}',
+                extra=dict(stock_id=stock['id'],
+                           code=stock['code'],
+                           price=quote['data_price'],
+                           action=result['action'],
+                           latency=quote['latency']))
+
+            # 売買が起きたときは Slack へ通知します。
+            # NOTE: キューに積むだけなので、ここでスクレイピングが待たされることはありません。
+            if result['action'] != 'keep':
+                utils.send_slack_message(
+                    f'user {strategy["user_id"]} {stock["code"]}'
+                    f' {quote["data_short_name"]} {result["message"]}')
+
+
+def start_run(owner: str) -> int:
+    """run を開始します。途中で止まった run があれば、それを再開します。
+    他の実行が run を処理中(リースが切れていない)なら、何もせず None を返します。
+
+    Args:
+        owner (str): この実行を識別する文字列。 run のリースの持ち主として記録します。
+
+    Returns:
+        int: run.id
+    """
+
+    with utils.DbClient() as db_client:
+        # NOTE: 二つの実行が同時に同じ run を再開したり、 run を二つ作ったりしないよう、
+        #       ロックを取ってから判断します。
+        if not db_client.acquire_run_lock():
+            logger.warning('他の実行が run を開始しているところなので、終了します。')
+            return None
+        try:
+            unfinished_run = db_client.fetch_unfinished_run()
+            if unfinished_run:
+                if not db_client.acquire_run_lease(unfinished_run['id'],
+                                                   owner,
+                                                   consts.RUN_LEASE_SECONDS):
+                    logger.warning(f'run {unfinished_run["id"]} は他の実行'
+                                   f' ({unfinished_run["locked_by"]}) が処理中なので、終了します。')
+                    return None
+                logger.info(f'run {unfinished_run["id"]}'
+                            f' ({unfinished_run["started_at"].isoformat()} 開始)'
+                            ' が途中で止まっているので、続きから再開します。')
+                return unfinished_run['id']
+            run_id = db_client.create_run(owner, consts.RUN_LEASE_SECONDS)
+        finally:
+            db_client.release_run_lock()
+    logger.info(f'run {run_id} を開始します。')
+    return run_id
+
+
+@utils.profiled('main')
 def run():
     """メインの実行関数です。
     他のモジュール…… execute_main_if_market_is_open から呼ばれることになったため、
     関数化しました。
+    NOTE: SHUUMULATOR_PROFILE を設定するか --profile を付けて実行すると、プロファイルを書き出します。
     """
 
-    # ロガーを取得します。
-    logger = utils.get_my_logger(__name__)
     current_utc = datetime.datetime.now(tz=pytz.utc)
     logger.info(f'Shuumulator started at {current_utc.isoformat()}')
     current_jst = datetime.datetime.now(tz=pytz.timezone('Asia/Tokyo'))
     logger.info(f'Shuumulator started at {current_jst.isoformat()}')
 
-    # 利確ラインを定義します。
-    profit_booking_rate = functions.get_profit_booking_rate()
-    logger.info(f'利確ライン {repr(profit_booking_rate)} で実行します。')
+    # run を開始します。途中で止まった run があれば、処理の済んでいない銘柄だけを処理します。
+    # NOTE: 前の実行がまだ処理中なら、同じ銘柄を二重に売買しないよう、何もせずに終わります。
+    owner = f'{socket.gethostname()}:{os.getpid()}'[:64]
+    run_id = start_run(owner)
+    if run_id is None:
+        return
+    try:
+        run_with_lease(run_id, owner)
+    finally:
+        # NOTE: 完了にできなかった run は、リースを手放して次の実行がすぐに再開できるようにします。
+        #       完了した run と、他の実行に取られた run のリースは持っていないので何もしません。
+        with utils.DbClient() as db_client:
+            db_client.release_run_lease(run_id, owner)
 
-    # ユーザの勝率を取得します。
-    user_wins_rate = functions.get_user_wins_rate(user_id=1)
-    logger.info(f'現在のユーザ勝率は {repr(user_wins_rate)} です。')
+    current_utc = datetime.datetime.now(tz=pytz.utc)
+    logger.info(f'Shuumulator finished at {current_utc.isoformat()}')
+    current_jst = datetime.datetime.now(tz=pytz.timezone('Asia/Tokyo'))
+    logger.info(f'Shuumulator finished at {current_jst.isoformat()}')
 
-    # 損切ラインを算出します。
-    # NOTE: 利確ラインと勝率がわかると損切ラインがわかります。
-    loss_cut_rate = functions.get_loss_cut_rate(profit_booking_rate,
-                                                user_wins_rate)
-    logger.info(f'損切ライン {repr(loss_cut_rate)} と算出されました。')
+    # 積んである Slack 通知を送り切ります。
+    utils.flush_slack_messages()
 
-    # DB から監視対象銘柄を取得します。
-    target_stocks = functions.get_target_stocks()
-    logger.info(f'対象銘柄は {len(target_stocks)} 件です。')
 
-    for stock in target_stocks:
-        # NOTE: stock は dict です。 { code, name }
+def run_with_lease(run_id: int, owner: str) -> None:
+    """リースを持っている run の銘柄を処理します。
 
-        # スクレイピング先に負荷をかけることを避けるため、待機します。
-        time.sleep(5)
+    Args:
+        run_id (int): run.id
+        owner (str): リースの持ち主。 start_run に渡したもの。
+    """
 
-        # スクレイピングで現在の価格を取得します。
-        _ = functions.get_current_stock_price(stock['code'])
-        current_stock_price = _['data_price']
-        stock_short_name = _['data_short_name']
+    # 仮想ユーザごとの戦略(利確ライン、勝率、損切ライン、保有中の trading)を用意します。
+    # NOTE: 利確ラインと勝率がわかると損切ラインがわかります。
+    strategies = functions.get_strategies()
+    for strategy in strategies:
+        logger.info(f'user {strategy["user_id"]}:'
+                    f' 利確ライン {repr(strategy["profit_booking_rate"])},'
+                    f' 勝率 {repr(strategy["user_wins_rate"])},'
+                    f' 損切ライン {repr(strategy["loss_cut_rate"])},'
+                    f' 保有 {len(strategy["open_tradings"])} 件で実行します。')
 
-        # stock_log 保存。
-        # NOTE: これが必要なのかは微妙ですね。せっかく取得した情報がもったいないと思い、記録しています。
-        with utils.DbClient() as db_client:
-            db_client.create_stock_log(
-                stock['id'],
-                current_stock_price
-            )
-
-        # この stock の買付、売付を行います。
-        result_dic = functions.deal_in(
-            stock_id=stock['id'],
-            current_stock_price=current_stock_price,
-            profit_booking_rate=profit_booking_rate,
-            loss_cut_rate=loss_cut_rate,
-        )
+    # スクレイピングの再試行予算とサーキットブレーカーは、この実行全体で共有します。
+    retry_budget = utils.RetryBudget(consts.FETCH_RETRY_BUDGET)
+    circuit_breaker = utils.CircuitBreaker(
+        failure_threshold=consts.FETCH_CIRCUIT_BREAKER_THRESHOLD,
+        reset_timeout=consts.FETCH_CIRCUIT_BREAKER_RESET_SECONDS,
+        max_probes=consts.FETCH_CIRCUIT_BREAKER_MAX_PROBES)
+    # 処理に失敗した銘柄コードです。最後にまとめて報告します。
+    failed_codes = []
+    # 株価を取得できた件数です。
+    quotes_count = 0
+    # 書き込みに失敗したバッチがあったかどうかです。
+    write_failed = False
+    # リースを他の実行に取られたかどうかです。
+    lease_lost = False
+    # 最後にリースを取った(延長した)時刻です。 start_run で取ったところから数えます。
+    lease_renewed_at = time.monotonic()
 
-        # NOTE: 銘柄の名称には stock['name'] を使うこともできます。
-        #       ただ、スクレイピングで stock_price と一緒に取得した値のほうが正確だと考えこれを使っています。
-        #       stock.name が間違っている可能性を考慮しているということです。
-        logger.info(f'{stock["id"]} {stock_short_name} {result_dic["message"]}')
+    # 銘柄の取得 -> 株価の取得 -> 売買判断 -> 書き込み、を少しずつ流します。
+    # NOTE: 銘柄は DB から少しずつ取得し、株価の取得は別スレッドで進めます。
+    #       株価が DEAL_BATCH_SIZE 件そろうか、 DEAL_BATCH_MAX_WAIT_SECONDS 秒経つたびに売買するので、
+    #       全銘柄の取得を待たずに、取得した株価が古くならないうちに売買します。
+    #       間のキューには上限があるので、銘柄が増えてもメモリ使用量は一定です。
+    # NOTE: ラインに近い銘柄ほど多く、遠い銘柄は少なく株価を取得するよう並べ直します。
+    stocks = functions.iter_scheduled_stocks(
+        functions.iter_target_stocks(consts.STOCK_CHUNK_SIZE),
+        strategies,
+        consts.STOCK_CHUNK_SIZE,
+        run_id)
+    quotes = iter_quotes(run_id, stocks, retry_budget, circuit_breaker, failed_codes)
+    for quote_batch in utils.iter_batches_in_background(
+            quotes,
+            consts.DEAL_BATCH_SIZE,
+            consts.DEAL_BATCH_MAX_WAIT_SECONDS,
+            consts.PIPELINE_QUEUE_SIZE):
+        # 処理中であることを示すため、バッチごとにリースを延長します。
+        # NOTE: 延長できないのは、リースが切れて他の実行が run を再開したときです。二重に売買しないよう止めます。
+        #       DB の一時的な不調で延長に失敗したときは、最後に延長したリースが切れるまでは処理を続けます。
+        try:
+            with utils.DbClient() as db_client:
+                lease_renewed = db_client.acquire_run_lease(
+                    run_id, owner, consts.RUN_LEASE_SECONDS)
+            if lease_renewed:
+                lease_renewed_at = time.monotonic()
+        except Exception:
+            logger.exception(f'run {run_id} のリースを延長できませんでした。')
+            lease_renewed = (time.monotonic() - lease_renewed_at
+                             < consts.RUN_LEASE_SECONDS)
+        if not lease_renewed:
+            logger.error(f'run {run_id} のリースを失ったので、処理を止めます。')
+            lease_lost = True
+            break
 
-    current_utc = datetime.datetime.now(tz=pytz.utc)
-    logger.info(f'Shuumulator finished at {current_utc.isoformat()}')
-    current_jst = datetime.datetime.now(tz=pytz.timezone('Asia/Tokyo'))
-    logger.info(f'Shuumulator finished at {current_jst.isoformat()}')
+        # 取得した株価を、すべての仮想ユーザに配って売買させます。
+        # NOTE: 書き込みに失敗した銘柄は処理済みにならないので、次の実行で処理し直します。
+        try:
+            deal_in_for_strategies(run_id, strategies, quote_batch)
+        except Exception:
+            logger.exception('売買の書き込みに失敗しました。')
+            write_failed = True
+            failed_codes.extend(quote['stock']['code'] for quote in quote_batch)
+            continue
+        quotes_count += len(quote_batch)
+
+    # NOTE: 同じ銘柄を複数回取得することがあるので、重複を除きます。
+    failed_codes = list(dict.fromkeys(failed_codes))
+    logger.info(f'株価の取得と売買 成功 {quotes_count} 件,'
+                f' 失敗 {len(failed_codes)} 銘柄です。')
+    if failed_codes:
+        logger.warning(f'失敗した銘柄: {",".join(failed_codes)}')
+        utils.send_slack_message(
+            f'Shuumulator: {len(failed_codes)} 件の銘柄の処理に失敗しました。'
+            f' {",".join(failed_codes)}')
+
+    # run を完了にします。
+    # NOTE: サイトが落ちていたり書き込みに失敗したりして処理できなかった銘柄があるときは、
+    #       完了にせず次の実行で続きから再開します。
+    #       ページが壊れている銘柄は処理済みとして記録しているので、 run が終わらなくなることはありません。
+    # NOTE: サーキットブレーカーの待機などでバッチが来ない間はリースを延長できないので、
+    #       その間に他の実行に取られていることがあります。そのときは完了にせず、その実行に任せます。
+    if lease_lost:
+        logger.warning(f'run {run_id} は他の実行が続きを処理します。')
+    elif not circuit_breaker.is_open() and not write_failed:
+        with utils.DbClient() as db_client:
+            finished = db_client.finish_run(run_id, owner)
+        if finished:
+            logger.info(f'run {run_id} を完了しました。')
+        else:
+            logger.warning(f'run {run_id} のリースを他の実行に取られていたので、完了にしません。')
+    else:
+        logger.warning(f'run {run_id} は次の実行で続きから再開します。')
 
 
 if __name__ == '__main__':
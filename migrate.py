@@ -0,0 +1,146 @@
+"""Module, applies schema migrations
+
+migrations ディレクトリの SQL ファイルを、バージョン順に未適用のものだけ適用するスクリプトです。
+適用済みのバージョンは schema_migrations テーブルに記録します。
+
+# 未適用のマイグレーションを適用します。
+python migrate.py
+
+# すでにテーブルのある DB で、0003 までを適用済みとして記録します。(SQL は実行しません。)
+python migrate.py --baseline 0003
+"""
+
+
+# Built-in modules.
+import argparse
+import datetime
+import os
+import pytz
+
+# User modules.
+import utils
+
+# ロガーを取得します。
+logger = utils.get_my_logger(__name__)
+
+# マイグレーションファイルを置くディレクトリです。
+# NOTE: ファイル名は 0001_create_stock.sql のように、先頭をバージョンにします。
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+
+
+def get_migrations() -> list:
+    """migrations ディレクトリのマイグレーションをバージョン順に取得します。
+
+    Returns:
+        list: [{version, path}]
+    """
+
+    migrations = []
+    for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not file_name.endswith('.sql'):
+            continue
+        migrations.append(dict(
+            version=file_name.split('_', 1)[0],
+            path=os.path.join(MIGRATIONS_DIR, file_name),
+        ))
+    return migrations
+
+
+def split_statements(sql: str) -> list:
+    """SQL ファイルの中身を文ごとに分割します。
+    NOTE: コメント行を除いてから ; で区切るだけの素朴な実装です。文字列中の ; は想定していません。
+
+    Args:
+        sql (str): SQL ファイルの中身。
+
+    Returns:
+        list: 文のリスト。
+    """
+
+    lines = [line for line in sql.splitlines()
+             if not line.strip().startswith('--')]
+    return [statement.strip()
+            for statement in '\n'.join(lines).split(';')
+            if statement.strip()]
+
+
+def fetch_applied_versions(db_client: utils.DbClient) -> set:
+    """適用済みのバージョンを取得します。 schema_migrations テーブルがなければ作成します。
+
+    Args:
+        db_client (utils.DbClient): 接続済みの DbClient
+
+    Returns:
+        set: 適用済みのバージョン
+    """
+
+    cursor = db_client.connection.cursor(dictionary=True)
+    cursor.execute(' '.join([
+        'CREATE TABLE IF NOT EXISTS schema_migrations (',
+            'version VARCHAR(32) NOT NULL,',  # noqa: E131
+            'applied_at DATETIME NOT NULL,',
+            'PRIMARY KEY (version)',
+        ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4',
+    ]))
+    cursor.execute('SELECT version FROM schema_migrations')
+    versions = {record['version'] for record in cursor.fetchall()}
+    cursor.close()
+    return versions
+
+
+def record_version(db_client: utils.DbClient, version: str) -> None:
+    """バージョンを適用済みとして記録します。
+
+    Args:
+        db_client (utils.DbClient): 接続済みの DbClient
+        version (str): バージョン
+    """
+
+    cursor = db_client.connection.cursor()
+    cursor.execute(
+        'INSERT INTO schema_migrations (version, applied_at) VALUES (%s, %s)',
+        (version, datetime.datetime.now(tz=pytz.utc))
+    )
+    cursor.close()
+    db_client.connection.commit()
+
+
+def migrate(baseline: str = None) -> None:
+    """未適用のマイグレーションを適用します。
+
+    Args:
+        baseline (str, optional): このバージョン以下は実行せず適用済みとして記録します。 Defaults to None.
+    """
+
+    with utils.DbClient() as db_client:
+        applied_versions = fetch_applied_versions(db_client)
+        for migration in get_migrations():
+            version = migration['version']
+            if version in applied_versions:
+                continue
+
+            if baseline and version <= baseline:
+                logger.info(f'{version} を適用済みとして記録します。')
+                record_version(db_client, version)
+                continue
+
+            logger.info(f'{os.path.basename(migration["path"])} を適用します。')
+            with open(migration['path'], encoding='utf-8') as f:
+                statements = split_statements(f.read())
+            # NOTE: MySQL の DDL は暗黙に commit されるので、ファイル単位のロールバックはできません。
+            #       途中で失敗したら、そのファイルは未適用のまま残ります。
+            cursor = db_client.connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.close()
+            record_version(db_client, version)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply schema migrations.')
+    parser.add_argument('--baseline',
+                        help='Record migrations up to this version as applied'
+                             ' without running them.')
+    args = parser.parse_args()
+    migrate(baseline=args.baseline)
@@ -0,0 +1,8 @@
+-- 監視対象銘柄です。
+CREATE TABLE IF NOT EXISTS stock (
+    id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+    code VARCHAR(16) NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE KEY uq_stock_code (code)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,12 @@
+-- 仮想ユーザの売買記録です。 sold_at が NULL のものは保有中です。
+CREATE TABLE IF NOT EXISTS trading (
+    id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+    stock_id INT UNSIGNED NOT NULL,
+    user_id INT UNSIGNED NOT NULL,
+    buy DECIMAL(12, 2) NOT NULL,
+    bought_at DATETIME NOT NULL,
+    sell DECIMAL(12, 2) NULL,
+    sold_at DATETIME NULL,
+    created_at DATETIME NOT NULL,
+    PRIMARY KEY (id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,8 @@
+-- スクレイピングで取得した株価の記録です。
+CREATE TABLE IF NOT EXISTS stock_log (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    stock_id INT UNSIGNED NOT NULL,
+    price DECIMAL(12, 2) NOT NULL,
+    created_at DATETIME NOT NULL,
+    PRIMARY KEY (id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,18 @@
+-- よく使うアクセスパスのためのインデックスです。
+
+-- 銘柄ごとの trading を新しい順に取得するためのものです。
+-- NOTE: いまの DbClient にこのアクセスパスを使うクエリはありません。(fetch_newest_trading は売買の判断を
+--       保有中の trading から行うようにしたときになくなりました。)
+--       銘柄ごとの売買履歴を調べる手元のクエリのために残しています。
+--       trading への書き込みは売買が起きたときだけなので、インデックスを保つ負荷は小さいです。
+ALTER TABLE trading
+    ADD INDEX idx_trading_stock_id_created_at (stock_id, created_at);
+
+-- ユーザごとの完了済み(sold_at IS NOT NULL)、保有中(sold_at IS NULL)の trading を取得するためのものです。
+-- NOTE: stock_id まで含めているので、ユーザと銘柄で保有中の trading を特定する UPDATE にも効きます。
+ALTER TABLE trading
+    ADD INDEX idx_trading_user_id_sold_at_stock_id (user_id, sold_at, stock_id);
+
+-- 銘柄ごとの株価を時系列で取得するためのものです。
+ALTER TABLE stock_log
+    ADD INDEX idx_stock_log_stock_id_created_at (stock_id, created_at);
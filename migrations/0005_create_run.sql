@@ -0,0 +1,15 @@
+-- 実行(run)です。 finished_at が NULL の run は途中で止まったもので、次の実行で続きから再開します。
+CREATE TABLE IF NOT EXISTS run (
+    id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+    started_at DATETIME NOT NULL,
+    finished_at DATETIME NULL,
+    PRIMARY KEY (id),
+    INDEX idx_run_finished_at (finished_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- run のなかで処理の済んだ銘柄(チェックポイント)です。
+CREATE TABLE IF NOT EXISTS run_stock (
+    run_id INT UNSIGNED NOT NULL,
+    stock_id INT UNSIGNED NOT NULL,
+    PRIMARY KEY (run_id, stock_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
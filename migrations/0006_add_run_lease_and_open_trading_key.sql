@@ -0,0 +1,12 @@
+-- run のリースです。 locked_until まで locked_by の実行が処理中なので、他の実行は再開しません。
+-- NOTE: 実行が落ちて延長されなくなったら、 locked_until を過ぎた時点で次の実行が再開します。
+ALTER TABLE run
+    ADD locked_until DATETIME NULL,
+    ADD locked_by VARCHAR(64) NULL;
+
+-- 保有中の trading は、ユーザと銘柄ごとに一件だけです。
+-- open_flag は保有中なら 1, 売却済みなら NULL です。 NULL 同士は重複とみなされないので、売却済みは何件でも持てます。
+-- NOTE: 保有中の trading が重複していると失敗します。先に重複を売却済みにしてから適用してください。
+ALTER TABLE trading
+    ADD open_flag TINYINT AS (IF(sold_at IS NULL, 1, NULL)) STORED,
+    ADD UNIQUE KEY uq_trading_open (user_id, stock_id, open_flag);
@@ -11,17 +11,51 @@ pipenv install python-dotenv mysql-connector-python
 with utils.DbClient() as db_client:
     records = db_client.sample_select()
 
-# logger の取得。
+# logger の取得。(何度呼んでもハンドラは重複しません。)
 logger = utils.get_my_logger(__name__)
+# 構造化フィールド付きのロギング。(LOG_JSONL_PATH を設定すると JSON Lines でも出力されます。)
+logger.info('message', extra=dict(stock_id=1, code='9434', action='buy'))
 
-# Slack メッセージの送信。
+# 再試行つきの呼び出し。(ジッター付き指数バックオフ、再試行予算、サーキットブレーカー)
+result = utils.call_with_retry(func, arg, max_attempts=3,
+                               retry_budget=utils.RetryBudget(20),
+                               circuit_breaker=utils.CircuitBreaker(5, 300))
+
+# 前段を別スレッドで回し、上限つきキュー越しに 10 件ずつ受け取る。
+for chunk in utils.iter_chunks(utils.iter_in_background(generator, 20), 10):
+    ...
+# 同じく 10 件ずつ。ただし 10 件そろわなくても、最初の要素から 15 秒経ったら受け取る。
+for batch in utils.iter_batches_in_background(generator, 10, 15.0, 20):
+    ...
+
+# プロファイリング。(SHUUMULATOR_PROFILE を設定するか --profile を付けて実行したときだけ計測します。)
+@utils.profiled('main')
+def run():
+    ...
+
+# Slack メッセージの送信。(キューに積むだけでブロックしません。)
 utils.send_slack_message(message)
+# 積んだ Slack メッセージを送り切る。
+utils.flush_slack_messages()
 """
 
 # Built-in modules.
+import atexit
+import contextlib
+import cProfile
+import functools
+import json
 import logging
+import logging.handlers
 import datetime
-from decimal import Decimal
+import os
+import pstats
+import queue
+import random
+import sys
+import threading
+import time
+import tracemalloc
 
 # Third-party modules.
 import mysql.connector
@@ -126,123 +160,344 @@ class DbClient:
 
         return self.fetch_completed_tradings(user=user, with_stock=True)
 
-    def fetch_newest_trading(self, stock_id: int) -> dict:
-        """最新の trading レコードを取得します。
-        存在しなければ None を返します。
+    def fetch_open_tradings(self, user: int) -> list:
+        """売付の済んでいない(保有中の) trading レコードを取得します。
 
         Args:
-            stock_id (int): stock.id
+            user (int): trading.user
 
         Returns:
-            dict: trading
+            list: tradings
         """
 
         select_sql = ' '.join([
             'SELECT *',
             'FROM trading',
-            'WHERE stock_id=%s',
-            'ORDER BY created_at DESC',
-            'LIMIT 1',
+            'WHERE user_id=%s AND sold_at IS NULL',
         ])
         cursor = self.connection.cursor(dictionary=True)
-        cursor.execute(select_sql, (stock_id,))
-        record = cursor.fetchone()
+        cursor.execute(select_sql, (user,))
+        records = cursor.fetchall()
         cursor.close()
-        return record
+        return records
+
+    def fetch_stocks(self, after_id: int, limit: int) -> list:
+        """stocks を id 順に、 after_id より後ろから limit 件取得します。
+        NOTE: OFFSET ではなく id で続きを指定する(keyset pagination)ので、何ページ目でも速いです。
 
-    def fetch_stocks(self) -> list:
-        """stocks を取得します。
+        Args:
+            after_id (int): 前回取得した最後の stock.id 。最初は 0 。
+            limit (int): 取得する件数。
 
         Returns:
             list: stocks
         """
 
         select_sql = ' '.join([
-            'SELECT * FROM shuumulator.stock',
+            'SELECT *',
+            'FROM stock',
+            'WHERE id > %s',
+            'ORDER BY id',
+            'LIMIT %s',
         ])
         cursor = self.connection.cursor(dictionary=True)
-        cursor.execute(select_sql)
+        cursor.execute(select_sql, (after_id, limit))
+        records = cursor.fetchall()
+        cursor.close()
+        return records
+
+    def fetch_latest_stock_logs(self, stock_ids: list) -> list:
+        """銘柄ごとに最新の stock_log を取得します。
+
+        Args:
+            stock_ids (list): stock.id のリスト
+
+        Returns:
+            list: stock_logs
+        """
+
+        if not stock_ids:
+            return []
+        select_sql = ' '.join([
+            'SELECT stock_log.stock_id, stock_log.price, stock_log.created_at',
+            'FROM stock_log',
+            'INNER JOIN (',
+                'SELECT stock_id, MAX(created_at) AS created_at',  # noqa: E131
+                'FROM stock_log',
+                f'WHERE stock_id IN ({get_placeholder(len(stock_ids))})',
+                'GROUP BY stock_id',
+            ') AS latest',
+            'ON stock_log.stock_id=latest.stock_id',
+            'AND stock_log.created_at=latest.created_at',
+        ])
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(select_sql, tuple(stock_ids))
         records = cursor.fetchall()
         cursor.close()
         return records
 
-    def create_stock_log(self, stock_id: int, price: Decimal) -> int:
-        """stock_log を INSERT します。
+    def fetch_unfinished_run(self) -> dict:
+        """途中で止まった(finished_at が NULL の)最新の run を取得します。
+        存在しなければ None を返します。
+
+        Returns:
+            dict: run
+        """
+
+        select_sql = ' '.join([
+            'SELECT *',
+            'FROM run',
+            'WHERE finished_at IS NULL',
+            'ORDER BY id DESC',
+            'LIMIT 1',
+        ])
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(select_sql)
+        record = cursor.fetchone()
+        cursor.close()
+        return record
+
+    def acquire_run_lock(self, timeout: int = 0) -> bool:
+        """run を開始するためのロック(GET_LOCK)を取ります。
+        ロックはこのコネクションに紐づくので、 release_run_lock まで同じ DbClient を使ってください。
 
         Args:
-            stock_id ([type]): stock.id
-            price ([type]): stock_log.price
+            timeout (int, optional): ロックを待つ秒数。 Defaults to 0.
 
         Returns:
-            int: created id
+            bool: 取れたら True 。
         """
 
+        select_sql = 'SELECT GET_LOCK(%s, %s) AS acquired'
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(select_sql, (consts.RUN_LOCK_NAME, timeout))
+        record = cursor.fetchone()
+        cursor.close()
+        return bool(record and record['acquired'])
+
+    def release_run_lock(self) -> None:
+        """acquire_run_lock で取ったロックを解放します。"""
+
+        select_sql = 'SELECT RELEASE_LOCK(%s) AS released'
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(select_sql, (consts.RUN_LOCK_NAME,))
+        cursor.fetchone()
+        cursor.close()
+
+    def create_run(self, owner: str, lease_seconds: int) -> int:
+        """run を一件追加します。追加した実行(owner)がリースを持ちます。
+
+        Args:
+            owner (str): 実行を識別する文字列
+            lease_seconds (int): リースの秒数
+
+        Returns:
+            int: created run.id
+        """
+
+        current_utc = datetime.datetime.now(tz=pytz.utc)
         insert_sql = ' '.join([
-            'INSERT INTO stock_log (stock_id, price, created_at)',
+            'INSERT INTO run (started_at, locked_until, locked_by)',
             'VALUES (%s, %s, %s)',
         ])
         cursor = self.connection.cursor(dictionary=True)
         cursor.execute(
             insert_sql,
-            (stock_id, price, datetime.datetime.now(tz=pytz.utc))
+            (current_utc,
+             current_utc + datetime.timedelta(seconds=lease_seconds),
+             owner)
         )
         last_row_id = cursor.lastrowid
         cursor.close()
         self.connection.commit()
         return last_row_id
 
-    def create_trading(self, stock_id: int, user_id: int,
-                       price: Decimal) -> int:
-        """trading を一件追加します。
+    def acquire_run_lease(self,
+                          run_id: int,
+                          owner: str,
+                          lease_seconds: int) -> bool:
+        """run のリースを取ります。すでに owner が持っていれば延長します。
+        他の実行のリースが切れていなければ取れません。
 
         Args:
-            stock_id (int): trading.stock
-            user_id (int): trading.user
-            price (Decimal): trading.buy
+            run_id (int): run.id
+            owner (str): 実行を識別する文字列
+            lease_seconds (int): リースの秒数
 
         Returns:
-            int: created trading.id
+            bool: 取れたら(延長できたら) True 。
         """
 
         current_utc = datetime.datetime.now(tz=pytz.utc)
-
-        insert_sql = ' '.join([
-            'INSERT INTO trading',
-            '(stock_id, user_id, buy, bought_at, created_at)',
-            'VALUES',
-            '(%s, %s, %s, %s, %s)',
+        update_sql = ' '.join([
+            'UPDATE run',
+            'SET locked_until=%s, locked_by=%s',
+            'WHERE id=%s',
+            'AND (locked_until IS NULL OR locked_until<%s OR locked_by=%s)',
+        ])
+        # NOTE: 値が変わらないと更新件数が 0 になるので、更新件数ではなく locked_by で判断します。
+        select_sql = ' '.join([
+            'SELECT locked_by',
+            'FROM run',
+            'WHERE id=%s',
         ])
         cursor = self.connection.cursor(dictionary=True)
         cursor.execute(
-            insert_sql,
-            (stock_id, user_id, price, current_utc, current_utc)
+            update_sql,
+            (current_utc + datetime.timedelta(seconds=lease_seconds), owner,
+             run_id, current_utc, owner)
         )
-        last_row_id = cursor.lastrowid
+        self.connection.commit()
+        cursor.execute(select_sql, (run_id,))
+        record = cursor.fetchone()
+        cursor.close()
+        return bool(record and record['locked_by'] == owner)
+
+    def release_run_lease(self, run_id: int, owner: str) -> None:
+        """owner が持っている run のリースを手放します。次の実行がすぐに再開できます。
+
+        Args:
+            run_id (int): run.id
+            owner (str): 実行を識別する文字列
+        """
+
+        update_sql = ' '.join([
+            'UPDATE run',
+            'SET locked_until=NULL, locked_by=NULL',
+            'WHERE id=%s AND locked_by=%s',
+        ])
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(update_sql, (run_id, owner))
         cursor.close()
         self.connection.commit()
-        return last_row_id
 
-    def update_trading(self, trading_id: int,
-                       sell_price: Decimal) -> None:
-        """trading.sell と trading.sold_at を更新します。
+    def finish_run(self, run_id: int, owner: str) -> bool:
+        """owner がリースを持っている run の finished_at を埋め、リースを手放します。
+        リースを他の実行に取られていたら何もしません。
 
         Args:
-            trading_id (int): trading.id
-            sell_price (Decimal): trading.sell
+            run_id (int): run.id
+            owner (str): 実行を識別する文字列
+
+        Returns:
+            bool: 完了にできたら True 。
         """
 
         update_sql = ' '.join([
-            'UPDATE trading',
-            'SET sell=%s, sold_at=%s',
-            'WHERE id=%s',
+            'UPDATE run',
+            'SET finished_at=%s, locked_until=NULL, locked_by=NULL',
+            'WHERE id=%s AND locked_by=%s',
         ])
         cursor = self.connection.cursor(dictionary=True)
         cursor.execute(
             update_sql,
-            (sell_price, datetime.datetime.now(tz=pytz.utc), trading_id)
+            (datetime.datetime.now(tz=pytz.utc), run_id, owner)
         )
+        finished = cursor.rowcount == 1
         cursor.close()
         self.connection.commit()
+        return finished
+
+    def fetch_finished_stock_ids(self, run_id: int, stock_ids: list) -> set:
+        """stock_ids のうち、 run のなかで処理の済んだものを取得します。
+
+        Args:
+            run_id (int): run.id
+            stock_ids (list): stock.id のリスト
+
+        Returns:
+            set: 処理の済んだ stock.id
+        """
+
+        if not stock_ids:
+            return set()
+        select_sql = ' '.join([
+            'SELECT stock_id',
+            'FROM run_stock',
+            f'WHERE run_id=%s AND stock_id IN ({get_placeholder(len(stock_ids))})',
+        ])
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(select_sql, (run_id, *stock_ids))
+        records = cursor.fetchall()
+        cursor.close()
+        return {record['stock_id'] for record in records}
+
+    def save_batch(self,
+                   run_id: int,
+                   stock_logs: list,
+                   operations: list,
+                   finished_stock_ids: list) -> None:
+        """株価の記録、売買、チェックポイントをひとつのトランザクションで書き込みます。
+        途中で失敗したら何も書き込まれないので、やり直しても二重に書き込まれません。
+        - stock_logs -> stock_log を追加します。
+        - operations を並び順どおりに実行します。
+          - action=buy -> 保有中でなければ trading を一件追加します。
+          - action=sell -> 保有中の trading の sell と sold_at を埋めます。
+        - finished_stock_ids -> run のなかで処理の済んだ銘柄として記録します。
+
+        Args:
+            run_id (int): run.id
+            stock_logs (list): [{stock_id, price}]
+            operations (list): [{user_id, action, stock_id, price}]
+            finished_stock_ids (list): stock.id のリスト
+        """
+
+        current_utc = datetime.datetime.now(tz=pytz.utc)
+
+        insert_stock_log_sql = ' '.join([
+            'INSERT INTO stock_log (stock_id, price, created_at)',
+            'VALUES (%s, %s, %s)',
+        ])
+        # NOTE: 保有中の trading があれば追加しません。何度実行しても一件だけです。
+        insert_trading_sql = ' '.join([
+            'INSERT INTO trading',
+            '(stock_id, user_id, buy, bought_at, created_at)',
+            'SELECT %s, %s, %s, %s, %s FROM DUAL',
+            'WHERE NOT EXISTS (',
+                'SELECT 1 FROM trading',  # noqa: E131
+                'WHERE user_id=%s AND stock_id=%s AND sold_at IS NULL',
+            ')',
+        ])
+        # NOTE: 同じ実行内で買った trading は id がわからないので、ユーザと銘柄で保有中のものを特定します。
+        update_trading_sql = ' '.join([
+            'UPDATE trading',
+            'SET sell=%s, sold_at=%s',
+            'WHERE user_id=%s AND stock_id=%s AND sold_at IS NULL',
+        ])
+        insert_run_stock_sql = ' '.join([
+            'INSERT IGNORE INTO run_stock (run_id, stock_id)',
+            'VALUES (%s, %s)',
+        ])
+
+        cursor = self.connection.cursor(dictionary=True)
+        try:
+            for stock_log in stock_logs:
+                cursor.execute(
+                    insert_stock_log_sql,
+                    (stock_log['stock_id'], stock_log['price'], current_utc)
+                )
+            for operation in operations:
+                if operation['action'] == 'buy':
+                    cursor.execute(
+                        insert_trading_sql,
+                        (operation['stock_id'], operation['user_id'],
+                         operation['price'], current_utc, current_utc,
+                         operation['user_id'], operation['stock_id'])
+                    )
+                else:
+                    cursor.execute(
+                        update_trading_sql,
+                        (operation['price'], current_utc,
+                         operation['user_id'], operation['stock_id'])
+                    )
+            for stock_id in finished_stock_ids:
+                cursor.execute(insert_run_stock_sql, (run_id, stock_id))
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
 
 
 def get_placeholder(count: int) -> str:
@@ -259,9 +514,258 @@ def get_placeholder(count: int) -> str:
     return ','.join(('%s' for i in range(count)))
 
 
+def iter_chunks(iterable, size: int):
+    """iterable を size 件ずつのリストにして返すジェネレータです。
+    for chunk in utils.iter_chunks(records, 10):
+
+    Args:
+        iterable: 分割したい iterable 。
+        size (int): 一つのリストの件数。
+
+    Yields:
+        list: 最大 size 件のリスト。
+    """
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _start_in_background(iterable, maxsize: int) -> tuple:
+    """iterable を別スレッドで回し始め、結果を上限つきのキューに積みます。
+    iter_in_background, iter_batches_in_background の前段です。
+
+    Args:
+        iterable: 別スレッドで回す iterable 。
+        maxsize (int): キューの上限件数。
+
+    Returns:
+        tuple: (キュー, 後段がやめたことを前段に伝える Event, 前段の終了を表す目印, 前段で起きた例外のリスト, 前段のスレッド)
+    """
+
+    item_queue = queue.Queue(maxsize=maxsize)
+    stop_event = threading.Event()
+    # 前段の終了と、前段で起きた例外を伝えるための目印です。
+    done = object()
+    errors = []
+
+    def put(item) -> bool:
+        # NOTE: 後段がやめたときに前段が put で止まったままにならないよう、タイムアウトつきで待ちます。
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        # NOTE: プロファイリング中なら、このスレッドのぶんも計測します。
+        #       計測結果は with を抜けたときに登録されるので、 done を積むのは抜けた後にします。
+        #       先に積むと、後段が終わって書き出すときに、このスレッドのぶんが間に合わないことがあります。
+        try:
+            with profile_thread():
+                for item in iterable:
+                    if not put(item):
+                        return
+        except Exception as e:
+            errors.append(e)
+        put(done)
+
+    producer = threading.Thread(target=produce,
+                                name='iter_in_background',
+                                daemon=True)
+    producer.start()
+    return item_queue, stop_event, done, errors, producer
+
+
+def _stop_in_background(stop_event: threading.Event,
+                        producer: threading.Thread,
+                        finished: bool) -> None:
+    """_start_in_background で始めた前段を止め、終わるのを待ちます。
+
+    Args:
+        stop_event (threading.Event): 後段がやめたことを前段に伝える Event
+        producer (threading.Thread): 前段のスレッド
+        finished (bool): 後段が done まで受け取ったかどうか
+    """
+
+    stop_event.set()
+    # NOTE: 後段が途中でやめたときは、前段が長い待機(サーキットブレーカーの待機など)の最中のこともあるので、
+    #       少しだけ待って諦めます。前段は daemon スレッドなので、プロセスの終了は妨げません。
+    producer.join(timeout=None if finished else 1.0)
+
+
+def iter_in_background(iterable, maxsize: int):
+    """iterable を別スレッドで回し、結果を上限つきのキュー越しに返すジェネレータです。
+    前段(例えばスクレイピング)と後段(例えば DB 書き込み)を並行に進められます。
+    キューが埋まると前段は待つので、メモリ使用量は maxsize 件ぶんに収まります。
+    for item in utils.iter_in_background(generator, 20):
+
+    Args:
+        iterable: 別スレッドで回す iterable 。
+        maxsize (int): キューの上限件数。
+
+    Raises:
+        Exception: 前段で起きた例外は、後段でそのまま raise します。
+
+    Yields:
+        iterable の要素。
+    """
+
+    item_queue, stop_event, done, errors, producer = _start_in_background(
+        iterable, maxsize)
+    finished = False
+    try:
+        while True:
+            item = item_queue.get()
+            if item is done:
+                break
+            yield item
+        finished = True
+        if errors:
+            raise errors[0]
+    finally:
+        _stop_in_background(stop_event, producer, finished)
+
+
+def iter_batches_in_background(iterable,
+                               batch_size: int,
+                               max_wait: float,
+                               maxsize: int):
+    """iter_in_background と同じく iterable を別スレッドで回し、 batch_size 件ずつのリストにして返すジェネレータです。
+    batch_size 件そろわなくても、バッチの最初の要素が届いてから max_wait 秒経ったら返します。
+    前段が遅いとき(例えばスクレイピングの待機)に、届いた要素がバッチがそろうまで待たされ続けないようにします。
+    for batch in utils.iter_batches_in_background(generator, 10, 15.0, 20):
+
+    Args:
+        iterable: 別スレッドで回す iterable 。
+        batch_size (int): 一つのリストの最大件数。
+        max_wait (float): バッチの最初の要素が届いてから、返すまでに待つ最大秒数。
+        maxsize (int): キューの上限件数。
+
+    Raises:
+        Exception: 前段で起きた例外は、後段でそのまま raise します。
+
+    Yields:
+        list: 最大 batch_size 件のリスト。
+    """
+
+    item_queue, stop_event, done, errors, producer = _start_in_background(
+        iterable, maxsize)
+    finished = False
+    try:
+        batch = []
+        deadline = None
+        while True:
+            try:
+                item = item_queue.get(
+                    timeout=(max(deadline - time.monotonic(), 0)
+                             if batch
+                             else None))
+            except queue.Empty:
+                yield batch
+                batch = []
+                continue
+            if item is done:
+                break
+            if not batch:
+                deadline = time.monotonic() + max_wait
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        finished = True
+        if batch:
+            yield batch
+        if errors:
+            raise errors[0]
+    finally:
+        _stop_in_background(stop_event, producer, finished)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ログを一行一 JSON で出力するフォーマッタです。一括で取り込めるようにするためのものです。
+    logger.info('...', extra=dict(stock_id=1, code='9434', price=..., action='buy', latency=0.3))
+    のように extra で渡した構造化フィールドも JSON の項目として出力します。
+    """
+
+    # extra で渡されたときに JSON へ含める項目です。
+    STRUCTURED_FIELDS = ('stock_id', 'code', 'price', 'action', 'latency')
+
+    def format(self, record: logging.LogRecord) -> str:
+        log = dict(
+            time=datetime.datetime.fromtimestamp(
+                record.created, tz=pytz.utc).isoformat(),
+            level=record.levelname,
+            name=record.name,
+            func=record.funcName,
+            message=record.getMessage(),
+        )
+        for field in self.STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                log[field] = getattr(record, field)
+        # NOTE: Decimal, datetime は default=str で文字列にします。
+        return json.dumps(log, ensure_ascii=False, default=str)
+
+
+# すべてのモジュール用ロガーが共有する QueueHandler と QueueListener です。
+# NOTE: ロガーは QueueHandler にレコードを積むだけで、フォーマットと I/O は QueueListener のスレッドが行います。
+_log_queue_handler = None
+_log_queue_listener = None
+_log_lock = threading.Lock()
+
+
+def _get_log_queue_handler() -> logging.handlers.QueueHandler:
+    """共有の QueueHandler を取得します。
+    初回呼び出し時に出力先のハンドラ群と QueueListener を一度だけ作成します。
+
+    Returns:
+        logging.handlers.QueueHandler: 共有の QueueHandler。
+    """
+
+    global _log_queue_handler, _log_queue_listener
+    with _log_lock:
+        if _log_queue_handler is not None:
+            return _log_queue_handler
+
+        # コンソールへ出力するハンドラを作成。
+        stream_handler = logging.StreamHandler()
+        # ハンドラもログレベルを持ちます。
+        stream_handler.setLevel(logging.DEBUG)
+        # ログフォーマットをハンドラに設定します。
+        stream_handler.setFormatter(logging.Formatter(
+            # NOTE: 改行は逆に見づらいので E501 を無視します。
+            '%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s'))  # noqa: E501
+        handlers = [stream_handler]
+
+        # LOG_JSONL_PATH が設定されていれば JSON Lines でも出力します。
+        if consts.LOG_JSONL_PATH:
+            jsonl_handler = logging.FileHandler(consts.LOG_JSONL_PATH,
+                                                encoding='utf-8')
+            jsonl_handler.setLevel(logging.DEBUG)
+            jsonl_handler.setFormatter(JsonLinesFormatter())
+            handlers.append(jsonl_handler)
+
+        log_queue = queue.SimpleQueue()
+        _log_queue_listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True)
+        _log_queue_listener.start()
+        # NOTE: プロセス終了時にキューに残っているログを書き切ります。
+        atexit.register(_log_queue_listener.stop)
+        _log_queue_handler = logging.handlers.QueueHandler(log_queue)
+        return _log_queue_handler
+
+
 def get_my_logger(logger_name: str) -> logging.Logger:
     """モジュール用のロガーを作成します。
     logger = get_my_logger(__name__)
+    同じ名前で何度呼んでもハンドラは重複しません。
 
     Args:
         logger_name (str): getLogger にわたす名前。 __name__ を想定しています。
@@ -270,59 +774,587 @@ def get_my_logger(logger_name: str) -> logging.Logger:
         logging.Logger: モジュール用のロガー。
     """
 
+    # ロガーを作成します。ロガーはモジュールごとに分けるもの。
+    logger = logging.getLogger(logger_name)
+    # ロガーのログレベルは DEBUG。
+    logger.setLevel(logging.DEBUG)
+    # 共有の QueueHandler をロガーへセットします。
+    handler = _get_log_queue_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    # 親ロガーへの伝播をオフにします。
+    logger.propagate = False
+    return logger
+
+
+class RetryBudget:
+    """一回の実行(run)全体で使える再試行回数の予算です。
+    不調なページが多いときに、再試行だけで実行時間を食いつぶさないようにします。
+    """
+
+    def __init__(self, max_retries: int):
+        self.remaining = max_retries
+
+    def try_spend(self) -> bool:
+        """予算を一回ぶん消費します。
+
+        Returns:
+            bool: 消費できたら True 。使い切っていたら False 。
+        """
+
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出しを行わなかったことを表す例外です。"""
+
+
+class CircuitBreaker:
+    """連続で失敗したら、しばらく呼び出しを止めるサーキットブレーカーです。
+    - 連続失敗が failure_threshold 回に達する -> 開く(呼び出さない)
+    - 開いてから reset_timeout 秒経つ -> 試しに一回だけ通す
+    - 成功する -> 閉じる(通常どおり呼び出す)
+    - 試しの呼び出しが max_probes 回続けて失敗する -> 諦める(以降は呼び出さない)
     """
-    メインの処理とは別に関係ない。
+
+    def __init__(self,
+                 failure_threshold: int,
+                 reset_timeout: float,
+                 max_probes: int = None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_probes = max_probes
+        self.consecutive_failures = 0
+        self.failed_probes = 0
+        self.opened_at = None
+
+    def is_open(self) -> bool:
+        """開いているか(試しの呼び出しを待っている間も含む)を返します。
+
+        Returns:
+            bool: 開いていれば True 。
+        """
+
+        return self.opened_at is not None
+
+    def is_exhausted(self) -> bool:
+        """試しの呼び出しが max_probes 回続けて失敗し、諦めたかを返します。
+
+        Returns:
+            bool: 諦めていれば True 。
+        """
+
+        return (self.max_probes is not None
+                and self.failed_probes >= self.max_probes)
+
+    def seconds_until_allowed(self) -> float:
+        """次に呼び出してよくなるまでの秒数を返します。
+
+        Returns:
+            float: 秒数。いま呼び出してよければ 0 。
+        """
+
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allows_request(self) -> bool:
+        """いま呼び出してよいかを返します。
+
+        Returns:
+            bool: 呼び出してよければ True 。
+        """
+
+        if self.is_exhausted():
+            return False
+        return self.seconds_until_allowed() <= 0
+
+    def record_success(self) -> None:
+        """呼び出しの成功を記録します。"""
+
+        self.consecutive_failures = 0
+        self.failed_probes = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        """呼び出しの失敗を記録します。"""
+
+        # NOTE: 試しの呼び出しが失敗したときは、もう reset_timeout 秒待ちます。
+        if self.opened_at is not None:
+            self.failed_probes += 1
+            self.opened_at = time.monotonic()
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def call_with_retry(func,
+                    *args,
+                    max_attempts: int = 3,
+                    retry_budget: RetryBudget = None,
+                    circuit_breaker: CircuitBreaker = None,
+                    base_delay: float = 1.0,
+                    max_delay: float = 30.0,
+                    retry_on: tuple = (Exception,),
+                    record_on: tuple = (),
+                    **kwargs):
+    """func を呼び、 retry_on の例外が起きたらジッター付き指数バックオフで再試行します。
+    result = utils.call_with_retry(func, arg, max_attempts=3, retry_on=(ValueError,))
+
+    NOTE: サーキットブレーカーには、呼び出し一回ぶん(再試行を含む)の成否を一度だけ記録します。
+          record_on の例外は、再試行はしませんが失敗として記録します。
+          それ以外の例外は、再試行しても直らない呼び出し側の問題とみなし、記録しません。
+
+    Args:
+        func: 呼び出す関数。
+        max_attempts (int, optional): 最大試行回数。 Defaults to 3.
+        retry_budget (RetryBudget, optional): 再試行のたびに消費する予算。 Defaults to None.
+        circuit_breaker (CircuitBreaker, optional): 成否を記録するサーキットブレーカー。 Defaults to None.
+        base_delay (float, optional): バックオフの基準秒数。 Defaults to 1.0.
+        max_delay (float, optional): バックオフの上限秒数。 Defaults to 30.0.
+        retry_on (tuple, optional): 再試行の対象とする例外。 Defaults to (Exception,).
+        record_on (tuple, optional): 再試行はせず、サーキットブレーカーに失敗として記録する例外。 Defaults to ().
+
+    Raises:
+        CircuitOpenError: サーキットブレーカーが開いている。
+        Exception: 試行回数か予算を使い切ったときは、最後に起きた例外をそのまま raise します。
 
     Returns:
-        Logger -- モジュール用のロガー。
+        func の返却値。
     """
 
-    # ルートロガーを作成します。ロガーはモジュールごとに分けるもの。
-    logger = logging.getLogger(logger_name)
-    # ルートロガーのログレベルは DEBUG。
-    logger.setLevel(logging.DEBUG)
-    # コンソールへ出力するハンドラを作成。
-    handler = logging.StreamHandler()
-    # ハンドラもログレベルを持ちます。
-    handler.setLevel(logging.DEBUG)
-    # ログフォーマットをハンドラに設定します。
-    formatter = logging.Formatter(
-        # NOTE: 改行は逆に見づらいので E501 を無視します。
-        '%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s')  # noqa: E501
-    handler.setFormatter(formatter)
-    # ハンドラをロガーへセットします。
-    logger.addHandler(handler)
-    # 親ロガーへの(伝播をオフにします。
-    logger.propagate = False
-    return logger
+    if circuit_breaker and not circuit_breaker.allows_request():
+        raise CircuitOpenError(f'Circuit is open. Skipped {func.__name__}.')
+    # NOTE: 試しの呼び出しは一回だけです。落ちているサイトに再試行を重ねないようにします。
+    if circuit_breaker and circuit_breaker.is_open():
+        max_attempts = 1
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            result = func(*args, **kwargs)
+        except retry_on as e:
+            if (attempt >= max_attempts
+                    or (retry_budget and not retry_budget.try_spend())):
+                if circuit_breaker:
+                    circuit_breaker.record_failure()
+                raise
+            # NOTE: full jitter です。一斉に再試行して相手に負荷をかけるのを避けます。
+            delay = random.uniform(
+                0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.warning(f'{func.__name__} failed: {e!r}.'
+                           f' Retry after {delay:.1f}s. ({attempt}/{max_attempts})')
+            time.sleep(delay)
+            continue
+        except record_on:
+            if circuit_breaker:
+                circuit_breaker.record_failure()
+            raise
+        if circuit_breaker:
+            circuit_breaker.record_success()
+        return result
+
+
+class SlackNotifier:
+    """Slack へのメッセージ送信をバックグラウンドスレッドで行うクラスです。
+    呼び出し側は send でキューに積むだけなので、 Slack との通信を待ちません。
+    flush_interval 秒以内に積まれたメッセージはまとめて一件の投稿(ダイジェスト)にします。
+    notifier = utils.SlackNotifier(token, channel)
+    notifier.send('めっせーじ')
+    notifier.close()
+
+    NOTE: base_url を渡すとローカルの偽 Slack エンドポイントに向けてテストできます。
+    """
+
+    # close 時にワーカーへ終了を伝えるための番兵です。
+    _SENTINEL = object()
+
+    # Slack 側の一時的なエラーを表す error です。再試行します。
+    SERVER_ERRORS = ('internal_error', 'fatal_error',
+                     'service_unavailable', 'request_timeout')
+
+    def __init__(self,
+                 token: str,
+                 channel: str,
+                 base_url: str = None,
+                 flush_interval: float = 1.0,
+                 max_batch_size: int = 50,
+                 max_retries: int = 5):
+        # NOTE: WebClient は使いまわします。呼ぶたびに作るのは無駄です。
+        self.slack_client = (WebClient(token=token, base_url=base_url)
+                             if base_url
+                             else WebClient(token=token))
+        self.channel = channel
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.message_queue = queue.Queue()
+        self.closed = False
+        self.worker = threading.Thread(target=self._work,
+                                       name='SlackNotifier',
+                                       daemon=True)
+        self.worker.start()
+
+    def send(self, message: str) -> None:
+        """メッセージをキューに積みます。ブロックしません。
+
+        Args:
+            message (str): 送信したいメッセージ。
+        """
+
+        if self.closed:
+            logger.warning(f'SlackNotifier is closed. Dropped: {message}')
+            return
+        self.message_queue.put_nowait(message)
+
+    def close(self, timeout: float = None) -> None:
+        """キューに残っているメッセージを送り切ってからワーカーを止めます。
+
+        Args:
+            timeout (float, optional): 送り切るのを待つ秒数。 Defaults to None.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self.message_queue.put(self._SENTINEL)
+        self.worker.join(timeout)
+
+    def _work(self) -> None:
+        """キューからメッセージを取り出してダイジェストとして投稿し続けます。"""
+
+        closing = False
+        while not closing:
+            message = self.message_queue.get()
+            if message is self._SENTINEL:
+                break
+
+            # flush_interval のあいだに積まれたものをひとつの投稿にまとめます。
+            messages = [message]
+            deadline = time.monotonic() + self.flush_interval
+            while len(messages) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = self.message_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if message is self._SENTINEL:
+                    closing = True
+                    break
+                messages.append(message)
+
+            self._post('\n'.join(messages))
+
+        # NOTE: 番兵のあとに積まれたものはありえないはずですが、念のため送り切ります。
+        leftovers = []
+        while True:
+            try:
+                message = self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+            if message is not self._SENTINEL:
+                leftovers.append(message)
+        if leftovers:
+            self._post('\n'.join(leftovers))
+
+    def _post(self, text: str) -> None:
+        """chat_postMessage を行います。
+        レート制限(429)なら Retry-After だけ待ち、それ以外の通信エラーは指数バックオフで再試行します。
+
+        Args:
+            text (str): 送信するテキスト。
+        """
+
+        backoff_seconds = 1
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                # NOTE: unfurl_links は時折鬱陶しいと思っている「リンクの展開機能」です。不要です。 False.
+                self.slack_client.chat_postMessage(
+                    channel=self.channel,
+                    text=text,
+                    unfurl_links=False)
+                return
+            except SlackApiError as e:
+                error = e.response.get('error')
+                if e.response.status_code == 429:
+                    wait_seconds = float(
+                        e.response.headers.get('Retry-After', backoff_seconds))
+                    logger.warning(f'Slack rate limited. Retry after {wait_seconds}s.'
+                                   f' ({attempt}/{self.max_retries})')
+                elif (e.response.status_code >= 500
+                      or error in self.SERVER_ERRORS):
+                    # NOTE: Slack 側の一時的なエラーなので、バックオフして再試行します。
+                    wait_seconds = backoff_seconds
+                    logger.warning(f'Slack server error: {error}'
+                                   f' ({e.response.status_code}).'
+                                   f' Retry after {wait_seconds}s.'
+                                   f' ({attempt}/{self.max_retries})')
+                else:
+                    # str like 'invalid_auth', 'channel_not_found'
+                    # NOTE: 再試行しても直らない類のエラーなので諦めます。
+                    logger.error(f'Got an error: {error}')
+                    return
+            except Exception as e:
+                wait_seconds = backoff_seconds
+                logger.warning(f'Slack post failed: {e!r}. Retry after {wait_seconds}s.'
+                               f' ({attempt}/{self.max_retries})')
+            time.sleep(wait_seconds)
+            backoff_seconds *= 2
+        logger.error(f'Gave up posting to Slack: {text}')
+
+
+# プロセス内で共有する SlackNotifier です。 get_slack_notifier で取得します。
+_slack_notifier = None
+_slack_notifier_lock = threading.Lock()
+
+
+def get_slack_notifier() -> SlackNotifier:
+    """プロセス内で共有する SlackNotifier を取得します。
+    初回呼び出し時に作成し、プロセス終了時に送り切るよう atexit へ登録します。
+
+    Returns:
+        SlackNotifier: 共有の SlackNotifier。
+    """
+
+    global _slack_notifier
+    with _slack_notifier_lock:
+        if _slack_notifier is None:
+            _slack_notifier = SlackNotifier(
+                token=consts.SLACK_BOT_TOKEN,
+                channel=consts.SLACK_MESSAGE_CHANNEL)
+            atexit.register(_slack_notifier.close)
+        return _slack_notifier
 
 
 def send_slack_message(message: str) -> None:
-    """slack_sdk を用いたメッセージ送信を行います。
+    """Slack へのメッセージ送信をキューに積みます。
+    実際の送信はバックグラウンドで行われ、近いタイミングのメッセージはまとめて投稿されます。
     Document: https://github.com/slackapi/python-slack-sdk/blob/main/tutorial/01-creating-the-slack-app.md  # noqa: E501
 
     Args:
         message (str): 送信したいメッセージ。
     """
 
-    slack_client = WebClient(token=consts.SLACK_BOT_TOKEN)
+    get_slack_notifier().send(message)
 
-    try:
-        # NOTE: unfurl_links は時折鬱陶しいと思っている「リンクの展開機能」です。不要です。 False.
-        response = slack_client.chat_postMessage(
-            channel=consts.SLACK_MESSAGE_CHANNEL,
-            text=message,
-            unfurl_links=False)
-        # NOTE: Slack api のドキュメントにあるコードですが、正常に終了しても false になる場合があるので注意。
-        #       リンクの含まれるメッセージを送信すると、返却値が勝手に変更されるため一致しません。
-        #       - リンクの前後に <, > がつく
-        #       - & -> &amp; エスケープが起こる
-        assert response['message']['text'] == message
-    except SlackApiError as e:
-        assert e.response['ok'] is False
-        # str like 'invalid_auth', 'channel_not_found'
-        assert e.response['error']
-        logger.error(f'Got an error: {e.response["error"]}')
+
+def flush_slack_messages(timeout: float = None) -> None:
+    """キューに積まれた Slack メッセージを送り切ります。
+    プロセスの終了を待たずに送り切りたいときに呼びます。
+
+    Args:
+        timeout (float, optional): 送り切るのを待つ秒数。 Defaults to None.
+    """
+
+    global _slack_notifier
+    with _slack_notifier_lock:
+        notifier, _slack_notifier = _slack_notifier, None
+    if notifier is not None:
+        notifier.close(timeout)
+
+
+class ProfileSession:
+    """一回の実行の CPU プロファイル(cProfile)とメモリ確保(tracemalloc)を記録するクラスです。
+    終了時に output_dir へ次のファイルを書き出します。
+    - {name}-{時刻}.pstats: cProfile の生データ。 snakeviz などで開けます。
+    - {name}-{時刻}.cpu.tsv: 累積時間の上位 top_n 関数。
+    - {name}-{時刻}.alloc.tsv: 開始時からのメモリ確保の増加量の上位 top_n 箇所。
+    tsv は行の並びと書式が安定しているので、 compare_profiles.py や diff で二回の実行を比べられます。
+    """
+
+    def __init__(self, name: str, output_dir: str, top_n: int):
+        self.name = name
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.profiler = cProfile.Profile()
+        self.thread_profilers = []
+        self.thread_profilers_lock = threading.Lock()
+
+    def __enter__(self):
+        tracemalloc.start()
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.disable()
+        end_snapshot = tracemalloc.take_snapshot()
+        _, self.peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.write(end_snapshot)
+
+    @contextlib.contextmanager
+    def profile_thread(self):
+        """呼び出したスレッドを計測します。 cProfile はスレッドごとに計測するためです。"""
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.thread_profilers_lock:
+                self.thread_profilers.append(profiler)
+
+    def write(self, end_snapshot: tracemalloc.Snapshot) -> None:
+        """計測結果をファイルに書き出し、上位をログに出します。
+
+        Args:
+            end_snapshot (tracemalloc.Snapshot): 終了時のスナップショット。
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        timestamp = datetime.datetime.now(tz=pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+        path_prefix = os.path.join(self.output_dir, f'{self.name}-{timestamp}')
+
+        # CPU プロファイルです。別スレッドのぶんも合算します。
+        stats = pstats.Stats(self.profiler)
+        with self.thread_profilers_lock:
+            for profiler in self.thread_profilers:
+                stats.add(profiler)
+        stats.dump_stats(f'{path_prefix}.pstats')
+        cpu_rows = sorted(
+            ((_format_profile_function(function), calls, tottime, cumtime)
+             for function, (_, calls, tottime, cumtime, _) in stats.stats.items()),
+            key=lambda row: (-row[3], row[0]))[:self.top_n]
+        with open(f'{path_prefix}.cpu.tsv', 'w', encoding='utf-8') as f:
+            f.write('function\tncalls\ttottime\tcumtime\n')
+            for function, calls, tottime, cumtime in cpu_rows:
+                f.write(f'{function}\t{calls}\t{tottime:.6f}\t{cumtime:.6f}\n')
+
+        # メモリ確保です。 tracemalloc 自身の確保は除きます。
+        ignore_filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        alloc_stats = end_snapshot.filter_traces(ignore_filters).compare_to(
+            self.start_snapshot.filter_traces(ignore_filters), 'lineno')
+        alloc_rows = sorted(
+            ((f'{_shorten_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}',
+              stat.size_diff / 1024, stat.size / 1024, stat.count)
+             for stat in alloc_stats),
+            key=lambda row: (-row[1], row[0]))[:self.top_n]
+        with open(f'{path_prefix}.alloc.tsv', 'w', encoding='utf-8') as f:
+            f.write('site\tsize_diff_kib\tsize_kib\tcount\n')
+            for site, size_diff_kib, size_kib, count in alloc_rows:
+                f.write(f'{site}\t{size_diff_kib:.1f}\t{size_kib:.1f}\t{count}\n')
+
+        logger.info(f'プロファイルを {path_prefix}.* に書き出しました。'
+                    f' メモリ確保のピークは {self.peak_memory / 1024:.1f} KiB です。')
+        for function, calls, tottime, cumtime in cpu_rows[:10]:
+            logger.info(f'cpu: {cumtime:.3f}s (self {tottime:.3f}s, {calls} calls) {function}')
+        for site, size_diff_kib, size_kib, count in alloc_rows[:10]:
+            logger.info(f'alloc: {size_diff_kib:+.1f} KiB ({count} blocks) {site}')
+
+
+def _shorten_path(path: str) -> str:
+    """プロファイルに出すファイルパスを短くします。
+    実行環境によって変わる部分を落とし、別の環境の結果とも比べられるようにします。
+
+    Args:
+        path (str): ファイルパス。
+
+    Returns:
+        str: このリポジトリ内なら相対パス、ライブラリなら site-packages 以下のパス。
+    """
+
+    repository_dir = os.path.dirname(os.path.abspath(__file__))
+    if path.startswith(repository_dir):
+        return os.path.relpath(path, repository_dir)
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in path:
+            return path.split(marker, 1)[1].lstrip(os.sep)
+    return os.path.basename(path)
+
+
+def _format_profile_function(function: tuple) -> str:
+    """pstats の関数キー (filename, lineno, funcname) を文字列にします。
+
+    Args:
+        function (tuple): (filename, lineno, funcname)
+
+    Returns:
+        str: filename:lineno(funcname)
+    """
+
+    filename, lineno, funcname = function
+    # NOTE: 組み込み関数は filename が '~' です。
+    if filename == '~':
+        return funcname
+    return f'{_shorten_path(filename)}:{lineno}({funcname})'
+
+
+# 実行中の ProfileSession です。プロファイリングしていなければ None です。
+_profile_session = None
+
+
+def profiling_enabled() -> bool:
+    """プロファイリングするかどうかを返します。
+    環境変数 SHUUMULATOR_PROFILE が設定されているか、コマンドライン引数に --profile があれば有効です。
+
+    Returns:
+        bool: プロファイリングするなら True 。
+    """
+
+    return bool(consts.SHUUMULATOR_PROFILE) or '--profile' in sys.argv
+
+
+@contextlib.contextmanager
+def profile_run(name: str):
+    """プロファイリングが有効なら、 with の中を計測してファイルに書き出します。
+    with utils.profile_run('main'):
+        ...
+
+    Args:
+        name (str): 書き出すファイル名の先頭に付ける名前。
+    """
+
+    global _profile_session
+    if not profiling_enabled() or _profile_session is not None:
+        yield
+        return
+    with ProfileSession(name, consts.PROFILE_DIR, consts.PROFILE_TOP_N) as session:
+        _profile_session = session
+        try:
+            yield
+        finally:
+            _profile_session = None
+
+
+def profile_thread():
+    """プロファイリング中なら、呼び出したスレッドも計測します。
+    with utils.profile_thread():
+        ...
+
+    Returns:
+        プロファイリング中なら ProfileSession.profile_thread 、そうでなければ何もしない context manager 。
+    """
+
+    session = _profile_session
+    if session is None:
+        return contextlib.nullcontext()
+    return session.profile_thread()
+
+
+def profiled(name: str):
+    """関数を profile_run で計測するデコレータです。
+    @utils.profiled('main')
+    def run():
+        ...
+
+    Args:
+        name (str): 書き出すファイル名の先頭に付ける名前。
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_run(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 # utils モジュール用のロガーを作成します。